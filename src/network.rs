@@ -15,6 +15,8 @@ use protocols::bgp::BGPRoute;
 use std::{
     collections::{BTreeMap, HashMap, HashSet},
     net::Ipv4Addr,
+    sync::{atomic::{AtomicUsize, Ordering}, Arc},
+    time::{Duration, Instant},
     vec,
 };
 use switch::PortState;
@@ -34,6 +36,7 @@ pub struct Network {
     peers: Vec<(String, u32, String, u32, u32)>,
     router_as: HashMap<u32, Vec<String>>,
     as_router: HashMap<String, u32>,
+    pending_bgp: Arc<AtomicUsize>,
     logger: Logger,
 }
 
@@ -48,18 +51,19 @@ impl Network {
             peers: vec![],
             router_as: HashMap::new(),
             as_router: HashMap::new(),
+            pending_bgp: Arc::new(AtomicUsize::new(0)),
             logger,
         }
     }
 
     pub fn add_switch(&mut self, name: &str, id: u32) {
-        let communicator = Switch::start(name.to_string(), id, self.logger.clone());
+        let communicator = Switch::start(name.to_string(), id, self.logger.clone(), Arc::clone(&self.pending_bgp));
         self.switches.insert(name.to_string(), communicator);
         self.used_port.insert(name.to_string(), HashSet::new());
     }
 
     pub fn add_router(&mut self, name: &str, id: u32, router_as: u32) {
-        let communicator = Router::start(name.to_string(), id, router_as, self.logger.clone());
+        let communicator = Router::start(name.to_string(), id, router_as, self.logger.clone(), Arc::clone(&self.pending_bgp));
         self.used_port.insert(name.to_string(), HashSet::new());
         self.routers.insert(
             name.to_string(),
@@ -201,9 +205,30 @@ impl Network {
     pub async fn announce_prefix(&self, router: &str) {
         let router = &self.routers.get(router).expect("Unknown router").0;
 
+        self.pending_bgp.fetch_add(1, Ordering::SeqCst);
         router.announce_prefix().await;
     }
 
+    pub async fn withdraw_prefix(&self, router: &str) {
+        let router = &self.routers.get(router).expect("Unknown router").0;
+
+        self.pending_bgp.fetch_add(1, Ordering::SeqCst);
+        router.withdraw_prefix().await;
+    }
+
+    // wait until every announce and bgp message has been processed, or until the timeout expires
+    // returns whether bgp converged
+    pub async fn converge(&self, timeout: Duration) -> bool {
+        let deadline = Instant::now() + timeout;
+        while self.pending_bgp.load(Ordering::SeqCst) > 0 {
+            if Instant::now() > deadline {
+                return false;
+            }
+            tokio::time::sleep(Duration::from_millis(5)).await;
+        }
+        true
+    }
+
     pub async fn announce_prefix_as(&self, announcing_as: u32) {
         for router in self.router_as.get(&announcing_as).unwrap(){
             self.announce_prefix(router).await;
@@ -221,7 +246,7 @@ impl Network {
     pub async fn get_bgp_routes(
         &self,
         router: &str,
-    ) -> HashMap<IPPrefix, (Option<BGPRoute>, HashSet<BGPRoute>)> {
+    ) -> BTreeMap<IPPrefix, (Option<BGPRoute>, Vec<BGPRoute>)> {
         let src = &self.routers.get(&router.to_string()).expect("Unknown router").0;
 
         src.get_bgp_routes()
@@ -229,6 +254,31 @@ impl Network {
             .expect("Failed to retrieve bgp routes")
     }
 
+    pub async fn get_all_bgp_routes(
+        &self,
+    ) -> BTreeMap<String, BTreeMap<IPPrefix, (Option<BGPRoute>, Vec<BGPRoute>)>> {
+        // ask every router first so that they all build their table concurrently
+        for (communicator, _) in self.routers.values() {
+            communicator.request_bgp_routes().await;
+        }
+        let mut tables = BTreeMap::new();
+        for (router, (communicator, _)) in self.routers.iter() {
+            let table = communicator
+                .receive_bgp_routes()
+                .await
+                .expect("Failed to retrieve bgp routes");
+            tables.insert(router.clone(), table);
+        }
+        tables
+    }
+
+    // clear the bgp tables of every router, to announce prefixes again on the same topology
+    pub async fn reset_bgp_tables(&self) {
+        for (communicator, _) in self.routers.values() {
+            communicator.reset_bgp().await;
+        }
+    }
+
     pub async fn quit(self) {
         for (_, communicator) in self.switches {
             communicator.quit().await;
@@ -279,7 +329,10 @@ impl Network {
 
     pub async fn print_bgp_table(&self, router: &str) {
         let bgp_table = self.get_bgp_routes(router).await;
+        Self::print_bgp_routes(router, bgp_table);
+    }
 
+    fn print_bgp_routes(router: &str, bgp_table: BTreeMap<IPPrefix, (Option<BGPRoute>, Vec<BGPRoute>)>) {
         println!("{}", router);
 
         for (prefix, (best_route, routes)) in bgp_table {
@@ -295,8 +348,8 @@ impl Network {
     }
 
     pub async fn print_bgp_tables(&self) {
-        for router in self.routers.keys() {
-            self.print_bgp_table(router).await;
+        for (router, bgp_table) in self.get_all_bgp_routes().await {
+            Self::print_bgp_routes(&router, bgp_table);
         }
     }
 
@@ -335,7 +388,12 @@ impl Network {
 
     pub async fn dot_representation(&self) -> String {
 
-        let mut graph = Graph::new(vec![GraphOption::RankSep("1".to_string()), GraphOption::NodeSep("1".to_string())]);
+        let mut graph_options = vec![GraphOption::RankSep("1".to_string()), GraphOption::NodeSep("1".to_string())];
+        if self.routers.len() + self.switches.len() > 200 {
+            // the default layout doesn't scale, use the multilevel one for large networks
+            graph_options.push(GraphOption::Layout("sfdp".to_string()));
+        }
+        let mut graph = Graph::new(graph_options);
         
         
         let (switch_as, others) = self.get_switch_as();
@@ -402,14 +460,47 @@ impl Network {
 #[cfg(test)]
 mod tests {
     use super::*;
+    use messages::{bgp::IBGPMessage, ip::{Content, IP}, Message};
     use protocols::bgp::RouteSource;
+    use utils::MacAddress;
     use std::thread;
     use std::time::Duration;
     use PortState::*;
 
+    // address of a router and prefix announced by an AS, see Router::start and BGPState::announce_prefix
+    const fn router_ip(router_as: u8, id: u8) -> Ipv4Addr {
+        Ipv4Addr::new(10, 0, router_as, id)
+    }
+
+    const fn as_prefix(router_as: u8) -> IPPrefix {
+        IPPrefix { ip: Ipv4Addr::new(10, 0, router_as, 0), prefix_len: 24 }
+    }
+
+    // bgp table as returned by a router, from the best route of each prefix and its other routes
+    fn bgp_table(entries: Vec<(BGPRoute, Vec<BGPRoute>)>) -> BTreeMap<IPPrefix, (Option<BGPRoute>, Vec<BGPRoute>)> {
+        entries
+            .into_iter()
+            .map(|(best, others)| {
+                let mut routes = others;
+                routes.push(best.clone());
+                routes.sort_by_key(|route| route.rib_order());
+                (best.prefix, (Some(best), routes))
+            })
+            .collect()
+    }
+
+    // compare the table of a router prefix by prefix, a failure only shows the routes of that prefix
+    async fn assert_bgp_routes(network: &Network, router: &str, expected: Vec<(BGPRoute, Vec<BGPRoute>)>) {
+        let mut table = network.get_bgp_routes(router).await;
+        for (prefix, routes) in bgp_table(expected) {
+            assert_eq!(table.remove(&prefix), Some(routes), "routes of {} for prefix {}", router, prefix);
+        }
+        assert!(table.is_empty(), "unexpected prefixes in the table of {}: {:?}", router, table.keys().collect::<Vec<_>>());
+    }
+
     #[tokio::test(flavor = "multi_thread", worker_threads = 6)]
     async fn test_spanning_tree() {
-        for _ in 0..10 {
+        for iteration in 0..10 {
             let logger = Logger::start_test();
             let mut network = Network::new(logger);
             network.add_switch("s1", 1);
@@ -462,7 +553,7 @@ mod tests {
                     .collect(),
             );
 
-            assert_eq!(expected, switch_states);
+            assert_eq!(expected, switch_states, "port states at iteration {}", iteration);
 
             network.quit().await;
         }
@@ -470,7 +561,7 @@ mod tests {
 
     #[tokio::test(flavor = "multi_thread", worker_threads = 4)]
     async fn test_ospf() {
-        for _ in 0..10 {
+        for iteration in 0..10 {
             let logger = Logger::start_test();
             let mut network = Network::new(logger);
             network.add_router("r1", 1, 1);
@@ -495,7 +586,9 @@ mod tests {
                     ("10.0.1.4/32".parse().unwrap(), (2, 2))
                 ]
                 .into_iter()
-                .collect()
+                .collect(),
+                "routing table of r1 at iteration {}",
+                iteration
             );
 
             assert_eq!(
@@ -507,7 +600,9 @@ mod tests {
                     ("10.0.1.4/32".parse().unwrap(), (2, 2))
                 ]
                 .into_iter()
-                .collect()
+                .collect(),
+                "routing table of r2 at iteration {}",
+                iteration
             );
 
             assert_eq!(
@@ -519,7 +614,9 @@ mod tests {
                     ("10.0.1.4/32".parse().unwrap(), (3, 1))
                 ]
                 .into_iter()
-                .collect()
+                .collect(),
+                "routing table of r3 at iteration {}",
+                iteration
             );
 
             assert_eq!(
@@ -531,7 +628,9 @@ mod tests {
                     ("10.0.1.4/32".parse().unwrap(), (0, 0))
                 ]
                 .into_iter()
-                .collect()
+                .collect(),
+                "routing table of r4 at iteration {}",
+                iteration
             );
 
             network.quit().await;
@@ -540,7 +639,7 @@ mod tests {
 
     #[tokio::test(flavor = "multi_thread", worker_threads = 6)]
     async fn test_mix_switches_routers() {
-        for _ in 0..10 {
+        for iteration in 0..10 {
             let logger = Logger::start_test();
             let mut network = Network::new(logger);
             network.add_router("r1", 1, 1);
@@ -567,7 +666,9 @@ mod tests {
                     ("10.0.1.2/32".parse().unwrap(), (1, 1))
                 ]
                 .into_iter()
-                .collect()
+                .collect(),
+                "routing table of r1 at iteration {}",
+                iteration
             );
 
             assert_eq!(
@@ -577,7 +678,9 @@ mod tests {
                     ("10.0.1.2/32".parse().unwrap(), (0, 0))
                 ]
                 .into_iter()
-                .collect()
+                .collect(),
+                "routing table of r2 at iteration {}",
+                iteration
             );
 
             thread::sleep(Duration::from_millis(250));
@@ -587,141 +690,128 @@ mod tests {
     }
 
     
-    #[tokio::test(flavor = "multi_thread", worker_threads = 16)]
-    async fn test_bgp() {
-        for _ in 0..5 {
-            let logger = Logger::start_test();
-            let mut network = Network::new(logger);
-            network.add_router("r1", 1, 1);
-            network.add_router("r2", 2, 2);
-            network.add_router("r3", 3, 3);
-            network.add_router("r4", 4, 4);
-
-            network
-                .add_provider_customer_link("r2", 1, "r1", 1, 0)
-                .await;
-            network
-                .add_provider_customer_link("r2", 2, "r4", 1, 0)
-                .await;
-            network
-                .add_provider_customer_link("r4", 3, "r3", 1, 0)
-                .await;
-
-            network
-                .add_peer_link("r1", 2, "r4", 2, 0)
-                .await;
-
-            network.announce_prefix("r1").await;
+    // r1 is a customer of r2 and a peer of r4, r4 is a customer of r2 and the provider of r3
+    // each test checks one router, so that cargo runs them in parallel
+    async fn bgp_network() -> Network {
+        let logger = Logger::start_test();
+        let mut network = Network::new(logger);
+        network.add_router("r1", 1, 1);
+        network.add_router("r2", 2, 2);
+        network.add_router("r3", 3, 3);
+        network.add_router("r4", 4, 4);
 
-            // wait for convergence
-            thread::sleep(Duration::from_millis(1000));
+        network
+            .add_provider_customer_link("r2", 1, "r1", 1, 0)
+            .await;
+        network
+            .add_provider_customer_link("r2", 2, "r4", 1, 0)
+            .await;
+        network
+            .add_provider_customer_link("r4", 3, "r3", 1, 0)
+            .await;
 
-            assert_eq!(
-                network.get_bgp_routes("r2").await,
-                [(
-                    "10.0.1.0/24".parse().unwrap(),
-                    (
-                        Some(BGPRoute {
-                            prefix: "10.0.1.0/24".parse().unwrap(),
-                            nexthop: "10.0.1.1".parse().unwrap(),
-                            as_path: vec![1],
-                            pref: 150,
-                            med: 0,
-                            router_id: 1,
-                            source: RouteSource::EBGP
-                        }),
-                        [BGPRoute {
-                            prefix: "10.0.1.0/24".parse().unwrap(),
-                            nexthop: "10.0.1.1".parse().unwrap(),
-                            as_path: vec![1],
-                            pref: 150,
-                            med: 0,
-                            router_id: 1,
-                            source: RouteSource::EBGP
-                        }]
-                        .into_iter()
-                        .collect()
-                    )
-                )]
-                .into_iter()
-                .collect()
-            );
+        network
+            .add_peer_link("r1", 2, "r4", 2, 0)
+            .await;
 
-            assert_eq!(
-                network.get_bgp_routes("r3").await,
-                [(
-                    "10.0.1.0/24".parse().unwrap(),
-                    (
-                        Some(BGPRoute {
-                            prefix: "10.0.1.0/24".parse().unwrap(),
-                            nexthop: "10.0.4.4".parse().unwrap(),
-                            as_path: vec![4, 1],
-                            pref: 50,
-                            med: 0,
-                            router_id: 4,
-                            source: RouteSource::EBGP
-                        }),
-                        [BGPRoute {
-                            prefix: "10.0.1.0/24".parse().unwrap(),
-                            nexthop: "10.0.4.4".parse().unwrap(),
-                            as_path: vec![4, 1],
-                            pref: 50,
-                            med: 0,
-                            router_id: 4,
-                            source: RouteSource::EBGP
-                        }]
-                        .into_iter()
-                        .collect()
-                    )
-                )]
-                .into_iter()
-                .collect()
-            );
+        network.announce_prefix("r1").await;
 
-            assert_eq!(
-                network.get_bgp_routes("r4").await,
-                [(
-                    "10.0.1.0/24".parse().unwrap(),
-                    (
-                        Some(BGPRoute {
-                            prefix: "10.0.1.0/24".parse().unwrap(),
-                            nexthop: "10.0.1.1".parse().unwrap(),
-                            as_path: vec![1],
-                            pref: 100,
-                            med: 0,
-                            router_id: 1,
-                            source: RouteSource::EBGP
-                        }),
-                        [
-                            BGPRoute {
-                                prefix: "10.0.1.0/24".parse().unwrap(),
-                                nexthop: "10.0.1.1".parse().unwrap(),
-                                as_path: vec![1],
-                                pref: 100,
-                                med: 0,
-                                router_id: 1,
-                                source: RouteSource::EBGP
-                            },
-                            BGPRoute {
-                                prefix: "10.0.1.0/24".parse().unwrap(),
-                                nexthop: "10.0.2.2".parse().unwrap(),
-                                as_path: vec![2, 1],
-                                pref: 50,
-                                med: 0,
-                                router_id: 2,
-                                source: RouteSource::EBGP
-                            }
-                        ]
-                        .into_iter()
-                        .collect()
-                    )
-                )]
-                .into_iter()
-                .collect()
-            );
+        assert!(network.converge(Duration::from_secs(10)).await, "BGP did not converge");
+        network
+    }
 
-            network.quit().await;
-        }
+    #[tokio::test(flavor = "multi_thread", worker_threads = 4)]
+    async fn test_bgp_r2() {
+        let network = bgp_network().await;
+
+        let route_r1 = BGPRoute {
+            prefix: as_prefix(1),
+            nexthop: router_ip(1, 1),
+            as_path: vec![1].into(),
+            pref: 150,
+            med: 0,
+            router_id: 1,
+            source: RouteSource::EBGP
+        };
+        assert_bgp_routes(&network, "r2", vec![(route_r1, vec![])]).await;
+
+        network.quit().await;
+    }
+
+    #[tokio::test(flavor = "multi_thread", worker_threads = 4)]
+    async fn test_bgp_r3() {
+        let network = bgp_network().await;
+
+        let route_r4 = BGPRoute {
+            prefix: as_prefix(1),
+            nexthop: router_ip(4, 4),
+            as_path: vec![4, 1].into(),
+            pref: 50,
+            med: 0,
+            router_id: 4,
+            source: RouteSource::EBGP
+        };
+        assert_bgp_routes(&network, "r3", vec![(route_r4, vec![])]).await;
+
+        network.quit().await;
+    }
+
+    #[tokio::test(flavor = "multi_thread", worker_threads = 4)]
+    async fn test_bgp_r4() {
+        let network = bgp_network().await;
+
+        assert_bgp_routes(&network, "r4", bgp_r4_table()).await;
+
+        network.quit().await;
+    }
+
+    // table of r4 in bgp_network
+    fn bgp_r4_table() -> Vec<(BGPRoute, Vec<BGPRoute>)> {
+        let route_r1 = BGPRoute {
+            prefix: as_prefix(1),
+            nexthop: router_ip(1, 1),
+            as_path: vec![1].into(),
+            pref: 100,
+            med: 0,
+            router_id: 1,
+            source: RouteSource::EBGP
+        };
+        let route_r2 = BGPRoute {
+            prefix: as_prefix(1),
+            nexthop: router_ip(2, 2),
+            as_path: vec![2, 1].into(),
+            pref: 50,
+            med: 0,
+            router_id: 2,
+            source: RouteSource::EBGP
+        };
+        vec![(route_r1, vec![route_r2])]
+    }
+
+    #[tokio::test(flavor = "multi_thread", worker_threads = 4)]
+    async fn test_bgp_reset_and_withdraw() {
+        let network = bgp_network().await;
+        assert!(network.get_routing_table("r4").await.contains_key(&as_prefix(1)));
+
+        // the topology is reused, announcing again after a reset converges to the same tables
+        network.reset_bgp_tables().await;
+        assert!(network.get_bgp_routes("r4").await.is_empty());
+        assert!(!network.get_routing_table("r4").await.contains_key(&as_prefix(1)));
+
+        network.announce_prefix("r1").await;
+        assert!(network.converge(Duration::from_secs(10)).await, "BGP did not converge");
+        assert_bgp_routes(&network, "r4", bgp_r4_table()).await;
+
+        // a withdrawn prefix is no longer installed, neither before nor after a reset
+        network.withdraw_prefix("r1").await;
+        assert!(network.converge(Duration::from_secs(10)).await, "BGP did not converge");
+        assert!(network.get_bgp_routes("r4").await.is_empty());
+        assert!(!network.get_routing_table("r4").await.contains_key(&as_prefix(1)));
+
+        network.reset_bgp_tables().await;
+        assert!(!network.get_routing_table("r4").await.contains_key(&as_prefix(1)));
+
+        network.quit().await;
     }
 
     #[tokio::test(flavor = "multi_thread", worker_threads = 8)]
@@ -774,126 +864,110 @@ mod tests {
 
         network.announce_prefix("r2").await;
 
-        // wait for convergence
-        thread::sleep(Duration::from_millis(2000));
-
-        let routes1 = [(
-            "10.0.2.0/24".parse().unwrap(),
-            (
-                Some(BGPRoute {
-                    prefix: "10.0.2.0/24".parse().unwrap(),
-                    nexthop: "10.0.2.2".parse().unwrap(),
-                    as_path: vec![2],
-                    pref: 150,
-                    med: 0,
-                    router_id: 2,
-                    source: RouteSource::EBGP,
-                }),
-                [BGPRoute {
-                    prefix: "10.0.2.0/24".parse().unwrap(),
-                    nexthop: "10.0.2.2".parse().unwrap(),
-                    as_path: vec![2],
-                    pref: 150,
-                    med: 0,
-                    router_id: 2,
-                    source: RouteSource::EBGP,
-                }]
-                .into_iter()
-                .collect(),
-            ),
-        )]
-            .into_iter()
-            .collect();
+        assert!(network.converge(Duration::from_secs(10)).await, "BGP did not converge");
 
-        assert_eq!(network.get_bgp_routes("r1").await, routes1);
+        let route_r2 = BGPRoute {
+            prefix: as_prefix(2),
+            nexthop: router_ip(2, 2),
+            as_path: vec![2].into(),
+            pref: 150,
+            med: 0,
+            router_id: 2,
+            source: RouteSource::EBGP,
+        };
+        assert_bgp_routes(&network, "r1", vec![(route_r2, vec![])]).await;
         network.quit().await;
     }
 
     #[tokio::test(flavor = "multi_thread", worker_threads = 5)]
     async fn test_ibgp(){
-        for _ in 0..5{
-            let logger = Logger::start_test();
-            let mut network = Network::new(logger);
-            network.add_router("r1", 1, 1);
-            network.add_router("r2", 2, 1);
-            network.add_router("r3", 3, 1);
-            network.add_router("r4", 4, 2);
-            network.add_router("r5", 5, 3);
-        
-            network
-                .add_provider_customer_link("r4", 1, "r1", 1, 0)
-                .await;
-        
-            network
-                .add_provider_customer_link("r3", 3, "r5", 3, 0)
-                .await;
-        
-            network
-                .add_link("r1", 2, "r2", 1, 0)
-                .await;
-            network
-                .add_link("r2", 2, "r3", 1, 0)
-                .await;
-            network
-                .add_link("r1", 3, "r3", 2, 0)
-                .await;
-        
-            let routers = ["r1", "r2", "r3"];
-            for i in 0..routers.len(){
-                for j in i+1..routers.len(){
-                    network.add_ibgp_connection(routers[i].into(), routers[j].into()).await;
-                }
+        let logger = Logger::start_test();
+        let mut network = Network::new(logger);
+        network.add_router("r1", 1, 1);
+        network.add_router("r2", 2, 1);
+        network.add_router("r3", 3, 1);
+        network.add_router("r4", 4, 2);
+        network.add_router("r5", 5, 3);
+    
+        network
+            .add_provider_customer_link("r4", 1, "r1", 1, 0)
+            .await;
+    
+        network
+            .add_provider_customer_link("r3", 3, "r5", 3, 0)
+            .await;
+    
+        network
+            .add_link("r1", 2, "r2", 1, 0)
+            .await;
+        network
+            .add_link("r2", 2, "r3", 1, 0)
+            .await;
+        network
+            .add_link("r1", 3, "r3", 2, 0)
+            .await;
+    
+        let routers = ["r1", "r2", "r3"];
+        for i in 0..routers.len(){
+            for j in i+1..routers.len(){
+                network.add_ibgp_connection(routers[i].into(), routers[j].into()).await;
             }
-        
-            // wait for convergence
-            thread::sleep(Duration::from_millis(1000));
-        
-            network.announce_prefix("r4").await;
-            network.announce_prefix("r5").await;
-        
-            thread::sleep(Duration::from_millis(1000));
-        
-            let bgp_table = network.get_bgp_routes("r2").await;
-            let mut expected_table = HashMap::new();
-            expected_table.insert("10.0.2.0/24".parse().unwrap(), (Some(BGPRoute{
-                prefix: "10.0.2.0/24".parse().unwrap(),
-                nexthop: "10.0.1.1".parse().unwrap(),
-                as_path: vec![2],
-                pref: 50,
-                med: 0,
-                router_id: 1,
-                source: RouteSource::IBGP,
-            }), [BGPRoute{
-                prefix: "10.0.2.0/24".parse().unwrap(),
-                nexthop: "10.0.1.1".parse().unwrap(),
-                as_path: vec![2],
-                pref: 50,
-                med: 0,
-                router_id: 1,
-                source: RouteSource::IBGP,
-            }].into_iter().collect()));
-
-            expected_table.insert("10.0.3.0/24".parse().unwrap(), (Some(BGPRoute{
-                prefix: "10.0.3.0/24".parse().unwrap(),
-                nexthop: "10.0.1.3".parse().unwrap(),
-                as_path: vec![3],
-                pref: 150,
-                med: 0,
-                router_id: 3,
-                source: RouteSource::IBGP,
-            }), [BGPRoute{
-                prefix: "10.0.3.0/24".parse().unwrap(),
-                nexthop: "10.0.1.3".parse().unwrap(),
-                as_path: vec![3],
-                pref: 150,
-                med: 0,
-                router_id: 3,
-                source: RouteSource::IBGP,
-            }].into_iter().collect()));
-            assert_eq!(bgp_table, expected_table);
-
-        
-            network.quit().await;
         }
+    
+        // wait for convergence of the IGP, ibgp messages are routed through it
+        thread::sleep(Duration::from_millis(1000));
+    
+        network.announce_prefix("r4").await;
+        network.announce_prefix("r5").await;
+    
+        assert!(network.converge(Duration::from_secs(10)).await, "BGP did not converge");
+    
+        let route_as2 = BGPRoute{
+            prefix: as_prefix(2),
+            nexthop: router_ip(1, 1),
+            as_path: vec![2].into(),
+            pref: 50,
+            med: 0,
+            router_id: 1,
+            source: RouteSource::IBGP,
+        };
+        let route_as3 = BGPRoute{
+            prefix: as_prefix(3),
+            nexthop: router_ip(1, 3),
+            as_path: vec![3].into(),
+            pref: 150,
+            med: 0,
+            router_id: 3,
+            source: RouteSource::IBGP,
+        };
+        assert_bgp_routes(&network, "r2", vec![(route_as2, vec![]), (route_as3, vec![])]).await;
+
+    
+        network.quit().await;
     }
-}
+
+    #[tokio::test(flavor = "multi_thread", worker_threads = 2)]
+    async fn test_ibgp_unreachable(){
+        let logger = Logger::start_test();
+        let mut network = Network::new(logger);
+        network.add_router("r1", 1, 1);
+
+        // link driven by the test, r1 is the first hop towards a peer it has no route to
+        let (tx1, rx1) = channel(1024);
+        let (tx2, _rx2) = channel(1024);
+        network.routers["r1"].0.add_link(rx1, tx2, 1, 1).await;
+
+        let ibgp = |mac| Message::EthernetFrame(mac, IP{
+            src: router_ip(1, 9),
+            dest: router_ip(1, 8),
+            content: Content::IBGP(IBGPMessage::Update(as_prefix(2), router_ip(1, 9), vec![2].into(), 100, 0, 9))
+        });
+        network.pending_bgp.fetch_add(2, Ordering::SeqCst);
+        tx1.send(ibgp(MacAddress{id: 1})).await.unwrap(); // dropped when forwarding
+        tx1.send(ibgp(MacAddress{id: 7})).await.unwrap(); // frame for another router
+
+        assert!(network.converge(Duration::from_secs(5)).await, "Dropped iBGP messages are still pending");
+
+        network.quit().await;
+    }
+}
\ No newline at end of file
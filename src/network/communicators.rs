@@ -1,6 +1,6 @@
 use crate::network::PortState;
 use crate::network::messages::Message;
-use std::{cell::RefCell, collections::{BTreeMap, HashMap, HashSet}, net::Ipv4Addr, rc::Rc};
+use std::{cell::RefCell, collections::{BTreeMap, HashMap}, net::Ipv4Addr, rc::Rc};
 use tokio::sync::mpsc::{Receiver, Sender};
 
 use super::{ip_prefix::IPPrefix, protocols::bgp::BGPRoute};
@@ -9,6 +9,7 @@ pub enum Command{
     StatePorts,
     RoutingTable,
     BGPRoutes,
+    ResetBGP,
     AddLink(Receiver<Message>, Sender<Message>, u32, u32),
     AddPeerLink(Receiver<Message>, Sender<Message>, u32, u32, Ipv4Addr),
     AddProvider(Receiver<Message>, Sender<Message>, u32, u32, Ipv4Addr),
@@ -16,13 +17,14 @@ pub enum Command{
     AddIBGP(Ipv4Addr),
     Ping(Ipv4Addr),
     AnnouncePrefix,
+    WithdrawPrefix,
     Quit
 }
 
 pub enum Response{
     StatePorts(BTreeMap<u32, PortState>),
     RoutingTable(HashMap<IPPrefix, (u32, u32)>),
-    BGPRoutes(HashMap<IPPrefix, (Option<BGPRoute>, HashSet<BGPRoute>)>)
+    BGPRoutes(BTreeMap<IPPrefix, (Option<BGPRoute>, Vec<BGPRoute>)>)
 }
 
 #[derive(Debug)]
@@ -87,6 +89,10 @@ impl RouterCommunicator {
         self.command_sender.send(Command::AnnouncePrefix).await.expect("Failed to send announce prefix command");
     }
 
+    pub async fn withdraw_prefix(&self){
+        self.command_sender.send(Command::WithdrawPrefix).await.expect("Failed to send withdraw prefix command");
+    }
+
     pub async fn get_routing_table(&self) -> Result<HashMap<IPPrefix, (u32, u32)>, ()>{
         self.command_sender.send(Command::RoutingTable).await.expect("Failed to send RoutingTable message");
         match self.response_receiver.borrow_mut().recv().await{
@@ -97,8 +103,16 @@ impl RouterCommunicator {
         }
     }
 
-    pub async fn get_bgp_routes(&self) -> Result<HashMap<IPPrefix, (Option<BGPRoute>, HashSet<BGPRoute>)>, ()>{
+    pub async fn get_bgp_routes(&self) -> Result<BTreeMap<IPPrefix, (Option<BGPRoute>, Vec<BGPRoute>)>, ()>{
+        self.request_bgp_routes().await;
+        self.receive_bgp_routes().await
+    }
+
+    pub async fn request_bgp_routes(&self){
         self.command_sender.send(Command::BGPRoutes).await.expect("Failed to send BGPRoutes message");
+    }
+
+    pub async fn receive_bgp_routes(&self) -> Result<BTreeMap<IPPrefix, (Option<BGPRoute>, Vec<BGPRoute>)>, ()>{
         match self.response_receiver.borrow_mut().recv().await{
             Some(Response::StatePorts(_)) => panic!("Unexpected answer"),
             Some(Response::BGPRoutes(routes)) => Ok(routes),
@@ -107,6 +121,10 @@ impl RouterCommunicator {
         }
     }
 
+    pub async fn reset_bgp(&self){
+        self.command_sender.send(Command::ResetBGP).await.expect("Failed to send reset bgp command");
+    }
+
     pub async fn quit(self){
         self.command_sender.send(Command::Quit).await.expect("Failed to send quit command");
     }
@@ -37,6 +37,7 @@ impl Display for NodeOption {
 pub enum GraphOption{
     NodeSep(String),
     RankSep(String),
+    Layout(String),
 }
 
 impl Display for GraphOption {
@@ -44,6 +45,7 @@ impl Display for GraphOption {
         match self {
             GraphOption::NodeSep(size) => write!(f, "nodesep=\"{}\"", size),
             GraphOption::RankSep(size) => write!(f, "ranksep=\"{}\"", size), 
+            GraphOption::Layout(engine) => write!(f, "layout={}", engine),
         }
     }
 }
@@ -79,37 +81,48 @@ impl Graph{
     }
 }
 
+fn write_options<T: Display>(f: &mut std::fmt::Formatter<'_>, options: &[T]) -> std::fmt::Result {
+    for (i, option) in options.iter().enumerate(){
+        if i > 0{
+            write!(f, ",")?;
+        }
+        write!(f, "{}", option)?;
+    }
+    Ok(())
+}
+
 impl Display for Graph{
     fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
-        let mut string = String::new();
-        string.push_str("digraph{\n");
-        
-        string.push_str(&format!(" graph[{}];\n", self.graph_options.iter().map(|o| format!("{}", o)).collect::<Vec<String>>().join(",")));
+        // written directly in the formatter, large networks would otherwise build many intermediate strings
+        writeln!(f, "digraph{{")?;
+
+        write!(f, " graph[")?;
+        write_options(f, &self.graph_options)?;
+        writeln!(f, "];")?;
 
         for (node, node_options) in self.nodes.iter(){
-            string.push_str(
-                &format!("  {}[{}];\n", node, node_options.iter().map(|o| format!("{}", o)).collect::<Vec<String>>().join(",")));
+            write!(f, "  {}[", node)?;
+            write_options(f, node_options)?;
+            writeln!(f, "];")?;
         }
 
         for (group, (group_label, nodes)) in self.groups.iter(){
-            string.push_str(
-                &format!("  subgraph cluster_{} {{\n", group));
-            string.push_str(
-                &format!("    label=\"{}\";\n", group_label));
+            writeln!(f, "  subgraph cluster_{} {{", group)?;
+            writeln!(f, "    label=\"{}\";", group_label)?;
             for (node, node_options) in nodes{
-                string.push_str(
-                    &format!("    {}[{}];\n", node, node_options.iter().map(|o| format!("{}", o)).collect::<Vec<String>>().join(",")));
+                write!(f, "    {}[", node)?;
+                write_options(f, node_options)?;
+                writeln!(f, "];")?;
             }
-            string.push_str(
-                &format!("  }}\n"));
+            writeln!(f, "  }}")?;
         }
 
         for (node1, node2, options) in self.edges.iter(){
-            string.push_str(
-                &format!("  {} -> {}[{}];\n", node1, node2, options.iter().map(|o| format!("{}", o)).collect::<Vec<String>>().join(",")));
+            write!(f, "  {} -> {}[", node1, node2)?;
+            write_options(f, options)?;
+            writeln!(f, "];")?;
         }
 
-        string.push_str("}");
-        write!(f, "{}", string)
+        write!(f, "}}")
     }
-}
\ No newline at end of file
+}
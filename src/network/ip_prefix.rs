@@ -1,9 +1,16 @@
-use std::{fmt::{Display, Error}, net::Ipv4Addr, str::FromStr};
+use std::{fmt::{Display, Error}, hash::{Hash, Hasher}, net::Ipv4Addr, str::FromStr};
 
-#[derive(Debug, PartialEq, Clone, Eq, Hash, Copy, Ord, PartialOrd)]
+#[derive(Debug, PartialEq, Clone, Eq, Copy, Ord, PartialOrd)]
 pub struct IPPrefix{
     pub ip: Ipv4Addr,
-    pub prefix_len: u32,
+    pub prefix_len: u8,
+}
+
+impl Hash for IPPrefix{
+    fn hash<H: Hasher>(&self, state: &mut H) {
+        // prefixes are the keys of every table, hash them as a single packed integer
+        state.write_u64((u64::from(u32::from(self.ip)) << 8) | u64::from(self.prefix_len));
+    }
 }
 
 impl Display for IPPrefix{
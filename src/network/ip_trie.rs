@@ -1,9 +1,8 @@
-use std::sync::Arc;
 use std::net::Ipv4Addr;
 
 use super::ip_prefix::IPPrefix;
 
-type Child<K> = Arc<IPTrieNode<K>>;
+type Child<K> = Box<IPTrieNode<K>>;
 
 #[derive(Debug)]
 struct IPTrieNode<K: Clone> {
@@ -12,129 +11,77 @@ struct IPTrieNode<K: Clone> {
     right: Option<Child<K>>,
 }
 
+impl<K: Clone> IPTrieNode<K> {
+    fn new() -> IPTrieNode<K> {
+        IPTrieNode{data: None, left: None, right: None}
+    }
+
+    fn child(&mut self, right: bool) -> &mut Option<Child<K>> {
+        if right { &mut self.right } else { &mut self.left }
+    }
+}
+
 #[derive(Debug)]
 pub struct IPTrie<K: Clone> {
-    root: Option<Child<K>>,
+    root: Child<K>,
 }
 
 impl<K: Clone> IPTrie<K> {
     pub fn new() -> IPTrie<K> {
-        IPTrie { root: Some(Arc::new(IPTrieNode{data: None, left: None, right: None})) }
+        IPTrie { root: Box::new(IPTrieNode::new()) }
     }
 
-    fn bits(&self, ip: Ipv4Addr) -> Vec<bool> {
-        let mut bits = vec![];
-        for byte in ip.octets() {
-            let mut mask = 1 << 7;
-            while mask > 0 {
-                bits.push((byte & mask) != 0);
-                mask = mask >> 1;
-            }
-        }
-        bits
+    fn bit(bits: u32, idx: u32) -> bool {
+        // bits are read from the most significant one
+        (bits >> (31 - idx)) & 1 == 1
     }
 
     pub fn insert(&mut self, prefix: IPPrefix, data: K) {
-        let bits = self.bits(prefix.ip);
+        // nodes are updated in place, only the missing ones on the path are allocated
+        let bits = u32::from(prefix.ip);
+        let mut node = &mut self.root;
+        for idx in 0..u32::from(prefix.prefix_len) {
+            node = node.child(Self::bit(bits, idx)).get_or_insert_with(|| Box::new(IPTrieNode::new()));
+        }
+        node.data = Some(data);
+    }
 
-        self.root = Self::insert_node(self.root.clone(), bits, 0, prefix.prefix_len, data);
+    pub fn remove(&mut self, prefix: IPPrefix) -> Option<K> {
+        Self::remove_node(&mut self.root, u32::from(prefix.ip), 0, u32::from(prefix.prefix_len))
     }
 
-    fn insert_node(
-        node: Option<Child<K>>,
-        bits: Vec<bool>,
-        idx: u32,
-        prefix_len: u32,
-        data: K,
-    ) -> Option<Child<K>> {
-        if idx == prefix_len{
-            match node {
-                Some(n) => Some(Arc::new(IPTrieNode {
-                    data: Some(data),
-                    left: n.left.clone(),
-                    right: n.right.clone(),
-                })),
-                None => Some(Arc::new(IPTrieNode {
-                    data: Some(data),
-                    left: None,
-                    right: None,
-                })),
-            }
-        } else {
-            match node {
-                Some(n) => {
-                    if bits[idx as usize] {
-                        Some(Arc::new(IPTrieNode {
-                            data: n.data.clone(),
-                            left: n.left.clone(),
-                            right: Self::insert_node(
-                                n.right.clone(),
-                                bits,
-                                idx + 1,
-                                prefix_len,
-                                data,
-                            ),
-                        }))
-                    } else {
-                        Some(Arc::new(IPTrieNode {
-                            data: n.data.clone(),
-                            left: Self::insert_node(
-                                n.left.clone(),
-                                bits,
-                                idx + 1,
-                                prefix_len,
-                                data,
-                            ),
-                            right: n.right.clone(),
-                        }))
-                    }
-                }
-                None => {
-                    if bits[idx as usize] {
-                        Some(Arc::new(IPTrieNode {
-                            data: None,
-                            left: None,
-                            right: Self::insert_node(None, bits, idx + 1, prefix_len, data),
-                        }))
-                    } else {
-                        Some(Arc::new(IPTrieNode {
-                            data: None,
-                            left: Self::insert_node(None, bits, idx + 1, prefix_len, data),
-                            right: None,
-                        }))
-                    }
-                }
+    fn remove_node(node: &mut Child<K>, bits: u32, idx: u32, prefix_len: u32) -> Option<K> {
+        if idx == prefix_len {
+            return node.data.take();
+        }
+        let child = node.child(Self::bit(bits, idx));
+        let removed = Self::remove_node(child.as_mut()?, bits, idx + 1, prefix_len);
+        // prune the branches that don't lead to any data anymore
+        if let Some(n) = child {
+            if n.data.is_none() && n.left.is_none() && n.right.is_none() {
+                *child = None;
             }
         }
+        removed
     }
 
     pub fn longest_match(&self, ip: Ipv4Addr) -> Option<K> {
-        let bits = self.bits(ip);
-        let mut data = None;
-
-        let mut curr = self.root.clone(); // clone a rc, cheap
+        let bits = u32::from(ip);
+        let mut data = self.root.data.as_ref();
 
-        let mut idx = 0;
-        while curr.is_some(){
-            let n = curr.unwrap();
+        let mut curr = &self.root;
 
-            if let Some(p) = &n.data {
-                data = Some(p.clone());
+        for idx in 0..32 {
+            let next = if Self::bit(bits, idx) { &curr.right } else { &curr.left };
+            match next {
+                Some(n) => curr = n,
+                None => break,
             }
-
-            if idx == 32{
-                break;
+            if let Some(p) = &curr.data {
+                data = Some(p);
             }
-
-            if bits[idx] {
-                curr = n.right.clone();
-            } else {
-                curr = n.left.clone();
-            }
-
-            idx += 1;
         }
-        data
+        data.cloned()
     }
 }
 
@@ -179,4 +126,18 @@ mod tests {
         assert_eq!(trie.longest_match("11.0.0.64".parse().unwrap()), Some(5));
         assert_eq!(trie.longest_match("47.0.0.64".parse().unwrap()), Some(5));
     }
+
+    #[test]
+    fn test_remove() {
+
+        let mut trie = IPTrie::new();
+
+        trie.insert("10.0.0.0/24".parse().unwrap(), 1); 
+        trie.insert("10.0.0.128/25".parse().unwrap(), 2); 
+
+        assert_eq!(trie.remove("10.0.0.128/25".parse().unwrap()), Some(2));
+        assert_eq!(trie.remove("10.0.0.128/25".parse().unwrap()), None);
+        assert_eq!(trie.remove("10.0.1.0/24".parse().unwrap()), None);
+        assert_eq!(trie.longest_match("10.0.0.164".parse().unwrap()), Some(1)); // falls back on the shorter prefix
+    }
 }
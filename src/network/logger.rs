@@ -1,10 +1,10 @@
 use std::{fmt::Display, sync::Arc};
 
-use log::info;
+use log::{info, log_enabled, Level};
 use strum_macros::EnumIter;
 use tokio::sync::{mpsc::{channel, Receiver, Sender}, Mutex};
 
-#[derive(EnumIter, PartialEq, Eq, Clone)]
+#[derive(EnumIter, PartialEq, Eq, Clone, Debug)]
 pub enum Source{
     OSPF,
     SPT,
@@ -33,15 +33,15 @@ impl Display for Source {
 #[derive(Debug)]
 pub struct Logger{
     sender: Arc<Mutex<Sender<(Source, String)>>>,
+    filters: Arc<Vec<Source>>,
+    active: bool,
 }
 
 impl Logger{
     pub fn start_test() -> Logger{
-        let (tx, rx) = channel(1024);
-        tokio::spawn(async move{
-            Self::write_loop(rx, vec![]).await
-        });
-        Logger{sender: Arc::new(Mutex::new(tx))}
+        // tests never install a log backend, nothing could be written so no writer task is spawned
+        let (tx, _) = channel(1);
+        Logger{sender: Arc::new(Mutex::new(tx)), filters: Arc::new(vec![]), active: false}
     }
 
     pub fn start() -> Logger{
@@ -50,16 +50,18 @@ impl Logger{
         tokio::spawn(async move{
             Self::write_loop(rx, vec![]).await
         });
-        Logger{sender: Arc::new(Mutex::new(tx))}
+        Logger{sender: Arc::new(Mutex::new(tx)), filters: Arc::new(vec![]), active: true}
     }
 
     pub fn start_with_filters(filters: Vec<Source>) -> Logger{
         env_logger::init();
         let (tx, rx) = channel(1024);
+        let filters = Arc::new(filters);
+        let write_filters = filters.to_vec();
         tokio::spawn(async move{
-            Self::write_loop(rx, filters).await
+            Self::write_loop(rx, write_filters).await
         });
-        Logger{sender: Arc::new(Mutex::new(tx))}
+        Logger{sender: Arc::new(Mutex::new(tx)), filters, active: true}
     }
 
     pub async fn write_loop(mut receiver: Receiver<(Source, String)>, filters: Vec<Source>){
@@ -76,11 +78,19 @@ impl Logger{
         }
     }
 
+    // whether a message from src would be written, allows to skip formatting messages nobody reads
+    pub fn enabled(&self, src: &Source) -> bool{
+        self.active && log_enabled!(Level::Info) && (self.filters.is_empty() || self.filters.contains(src))
+    }
+
     pub async fn log(&self, src: Source, msg: String){
+        if !self.enabled(&src){
+            return;
+        }
         self.sender.lock().await.send((src, msg)).await.expect("Failed to log");
     }
 
     pub fn clone(&self) -> Logger{
-        Logger{sender: Arc::clone(&self.sender)}
+        Logger{sender: Arc::clone(&self.sender), filters: Arc::clone(&self.filters), active: self.active}
     }
 }
\ No newline at end of file
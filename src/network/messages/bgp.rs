@@ -1,11 +1,11 @@
 use std::{fmt::Display, net::Ipv4Addr};
 
-use crate::network::ip_prefix::IPPrefix;
+use crate::network::{ip_prefix::IPPrefix, protocols::bgp::{ASPath, DisplayASPath}};
 
 #[derive(Debug, Clone)]
 pub enum BGPMessage{
-    Update(IPPrefix, Ipv4Addr, Vec<u32>, u32, u32), // prefix, nexthop, as-path, med, router_id
-    Withdraw(IPPrefix, Ipv4Addr, Vec<u32>, u32)     // prefix, nexthop, as-path, router_id
+    Update(IPPrefix, Ipv4Addr, ASPath, u32, u32), // prefix, nexthop, as-path, med, router_id (replaces the previous route of the sender)
+    Withdraw(IPPrefix, Ipv4Addr, ASPath, u32)     // prefix, nexthop, as-path, router_id
 }
 
 impl Display for BGPMessage{
@@ -13,18 +13,18 @@ impl Display for BGPMessage{
         match self{
             BGPMessage::Update(prefix, nexthop, as_path, med, router_id) => 
                 write!(f, "UPDATE(prefix={}, nexthop={}, as_path={}, med={}, router_id={})", 
-                    prefix, nexthop, as_path.iter().map(|a| format!("AS{}", a)).collect::<Vec<String>>().join(":"), med, router_id),
+                    prefix, nexthop, DisplayASPath(as_path), med, router_id),
             BGPMessage::Withdraw(prefix, nexthop, as_path, router_id) =>                 
                 write!(f, "WITHDRAW(prefix={}, nexthop={}, as_path={}, router_id={})", 
-                    prefix, nexthop, as_path.iter().map(|a| format!("AS{}", a)).collect::<Vec<String>>().join(":"), router_id)
+                    prefix, nexthop, DisplayASPath(as_path), router_id)
         }
     }
 }
 
 #[derive(Debug, Clone)]
 pub enum IBGPMessage{
-    Update(IPPrefix, Ipv4Addr, Vec<u32>, u32, u32, u32), // prefix, nexthop, as-path, pref, med, router_id
-    Withdraw(IPPrefix, Ipv4Addr, Vec<u32>, u32)     // prefix, nexthop, as-path, router_id
+    Update(IPPrefix, Ipv4Addr, ASPath, u32, u32, u32), // prefix, nexthop, as-path, pref, med, router_id
+    Withdraw(IPPrefix, Ipv4Addr, ASPath, u32)     // prefix, nexthop, as-path, router_id
 }
 
 impl Display for IBGPMessage{
@@ -32,10 +32,10 @@ impl Display for IBGPMessage{
         match self{
             IBGPMessage::Update(prefix, nexthop, as_path, pref, med, router_id) => 
                 write!(f, "UPDATE(prefix={}, nexthop={}, as_path={}, pref={}, med={}, router_id={})", 
-                    prefix, nexthop, as_path.iter().map(|a| format!("AS{}", a)).collect::<Vec<String>>().join(":"), pref, med, router_id),
+                    prefix, nexthop, DisplayASPath(as_path), pref, med, router_id),
             IBGPMessage::Withdraw(prefix, nexthop, as_path, router_id) =>                 
                 write!(f, "WITHDRAW(prefix={}, nexthop={}, as_path={}, router_id={})", 
-                    prefix, nexthop, as_path.iter().map(|a| format!("AS{}", a)).collect::<Vec<String>>().join(":"), router_id)
+                    prefix, nexthop, DisplayASPath(as_path), router_id)
         }
     }
 }
\ No newline at end of file
@@ -7,7 +7,7 @@ pub mod arp;
 use arp::ARPMessage;
 use bpdu::BPDU;
 use ospf::OSPFMessage;
-use ip::IP;
+use ip::{Content, IP};
 use bgp::BGPMessage;
 
 use super::utils::MacAddress;
@@ -20,4 +20,11 @@ pub enum Message{
     EthernetFrame(MacAddress, IP),
     BGP(BGPMessage),
     ARP(ARPMessage)
+}
+
+impl Message{
+    // ibgp messages are counted in the pending bgp messages of the network until they are processed or dropped
+    pub fn is_ibgp(&self) -> bool{
+        matches!(self, Message::EthernetFrame(_, IP{content: Content::IBGP(_), ..}))
+    }
 }
\ No newline at end of file
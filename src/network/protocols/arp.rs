@@ -15,7 +15,9 @@ impl ArpState{
     }
 
     pub async fn resolve(&self, ip: Ipv4Addr, port: u32){
-        self.logger.log(Source::ARP, format!("Router {} sending resolving request for {}", self.router_info.lock().await.name, ip)).await;
+        if self.logger.enabled(&Source::ARP){
+            self.logger.log(Source::ARP, format!("Router {} sending resolving request for {}", self.router_info.lock().await.name, ip)).await;
+        }
         let info = self.router_info.lock().await;
         if let Some((_, sender)) = info.neighbors_links.get(&port){
             sender.send(Message::ARP(ARPMessage::Request(ip))).await.expect("Failed to send arp message");
@@ -23,7 +25,9 @@ impl ArpState{
     }
 
     pub async fn process_request(&mut self, ip: Ipv4Addr, port: u32){
-        self.logger.log(Source::ARP, format!("Router {} received request for mapping of ip {}", self.router_info.lock().await.name, ip)).await;
+        if self.logger.enabled(&Source::ARP){
+            self.logger.log(Source::ARP, format!("Router {} received request for mapping of ip {}", self.router_info.lock().await.name, ip)).await;
+        }
         let info = self.router_info.lock().await;
         if info.ip != ip{
             return;
@@ -35,7 +39,9 @@ impl ArpState{
 
     pub async fn process_reply(&mut self, ip: Ipv4Addr, mac_address: MacAddress){
         self.mapping.insert(ip, mac_address);
-        self.logger.log(Source::ARP, format!("Router {} has mappings : {:?}", self.router_info.lock().await.name, self.mapping)).await;
+        if self.logger.enabled(&Source::ARP){
+            self.logger.log(Source::ARP, format!("Router {} has mappings : {:?}", self.router_info.lock().await.name, self.mapping)).await;
+        }
     }
 
     pub async fn process_arp_message(&mut self, arp_message: ARPMessage, port: u32){
@@ -1,4 +1,4 @@
-use std::{borrow::Borrow, collections::{hash_map::Entry, HashMap, HashSet}, fmt::Display, net::Ipv4Addr};
+use std::{borrow::Borrow, cmp::{Ordering, Reverse}, collections::{hash_map::Entry, HashMap}, fmt::Display, net::Ipv4Addr, sync::{atomic::{self, AtomicUsize}, Arc}};
 
 use crate::network::{
     ip_prefix::IPPrefix, ip_trie::IPTrie, logger::{Logger, Source}, messages::{bgp::{BGPMessage, IBGPMessage}, ip::{Content, IP}, Message}, router::RouterInfo, utils::SharedState
@@ -6,47 +6,94 @@ use crate::network::{
 
 use super::ospf::OSPFState;
 
-#[derive(Debug, PartialEq, Clone, Eq, Hash)]
+#[derive(Debug, PartialEq, Clone, Copy, Eq, Hash)]
 pub enum RouteSource{
     IBGP,
     EBGP
 }
 
+// local preference given to routes depending on the relation with the neighbor
+pub const CUSTOMER_PREF: u32 = 150;
+pub const PEER_PREF: u32 = 100;
+pub const PROVIDER_PREF: u32 = 50;
+
+pub type ASPath = Arc<[u32]>; // shared between all the routes with the same path
+
+pub struct DisplayASPath<'a>(pub &'a [u32]); // AS1:AS2:..., without allocating
+
+impl Display for DisplayASPath<'_>{
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        for (i, as_number) in self.0.iter().enumerate(){
+            if i > 0{
+                write!(f, ":")?;
+            }
+            write!(f, "AS{}", as_number)?;
+        }
+        Ok(())
+    }
+}
+
 #[derive(Debug, PartialEq, Clone, Eq, Hash)]
 pub struct BGPRoute{
     pub prefix: IPPrefix,
     pub nexthop: Ipv4Addr,
-    pub as_path: Vec<u32>,
+    pub as_path: ASPath,
     pub pref: u32,
     pub med: u32,
     pub router_id: u32,
     pub source: RouteSource
 }
 
+impl BGPRoute{
+    // decision process order on the attributes known without the igp, lists the routes of a prefix deterministically
+    pub fn rib_order(&self) -> (Reverse<u32>, usize, u32, bool, u32, Ipv4Addr){
+        (Reverse(self.pref), self.as_path.len(), self.med, self.source == RouteSource::IBGP, self.router_id, self.nexthop)
+    }
+}
+
 impl Display for BGPRoute{
     fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
-        let path = self.as_path.iter().map(|v| format!("AS{}", v)).collect::<Vec<String>>().join(":");
-        write!(f, "nexthop={}, AS path={}, pref={}, med={}", self.nexthop, path, self.pref, self.med)
+        write!(f, "nexthop={}, AS path={}, pref={}, med={}", self.nexthop, DisplayASPath(&self.as_path), self.pref, self.med)
     }
 }
 
+type PeerKey = (Ipv4Addr, u32); // nexthop, router_id of the peer that sent the route
+
+#[derive(Debug, Default)]
+pub struct BGPRib{
+    pub paths: HashMap<PeerKey, BGPRoute>, // one route per peer
+    pub best: Option<BGPRoute>             // refreshed only when paths change
+}
+
 #[derive(Debug)]
 pub struct BGPState {
+    pub name: String,
+    pub id: u32,
+    pub router_as: u32,
+    pub ip: Ipv4Addr,
     pub router_info: SharedState<RouterInfo>,
     pub igp_info: SharedState<OSPFState>,
     pub logger: Logger,
-    pub routes: HashMap<IPPrefix, HashSet<BGPRoute>>,
-    pub prefixes: IPTrie<IPPrefix>
+    pub routes: HashMap<IPPrefix, BGPRib>,
+    pub prefixes: IPTrie<IPPrefix>,
+    pub as_paths: HashMap<ASPath, usize>, // interned paths, with the number of routes of this router using them
+    pub pending_bgp: Arc<AtomicUsize>
 }
 
 impl BGPState {
-    pub fn new(router_info: SharedState<RouterInfo>, igp_info: SharedState<OSPFState>, logger: Logger) -> BGPState {
+    pub fn new(name: String, id: u32, router_as: u32, ip: Ipv4Addr, router_info: SharedState<RouterInfo>, igp_info: SharedState<OSPFState>, logger: Logger, pending_bgp: Arc<AtomicUsize>) -> BGPState {
         BGPState {
+            name,
+            id,
+            router_as,
+            ip,
             router_info,
             igp_info,
             logger,
             routes: HashMap::new(),
-            prefixes: IPTrie::new()
+            prefixes: IPTrie::new(),
+            as_paths: HashMap::new(),
+            pending_bgp
         }
     }
 
@@ -78,108 +125,160 @@ impl BGPState {
         igp_state.routing_table.insert(route.prefix, (port, 0));
     }
 
+    pub async fn reset(&mut self){
+        // forget every learned route, the links and sessions are kept.
+        // Prefixes left without route are already uninstalled by remove_route
+        let mut igp_state = self.igp_info.lock().await;
+        for prefix in self.routes.keys(){
+            igp_state.routing_table.remove(prefix);
+        }
+        drop(igp_state);
+        self.routes.clear();
+        self.prefixes = IPTrie::new();
+        self.as_paths.clear();
+    }
+
+    pub fn intern_as_path(&mut self, as_path: ASPath) -> ASPath{
+        // many prefixes are reached through the same path, keep a single copy of it.
+        // The allocation is also held by messages and other routers, so the uses are counted
+        // explicitly instead of relying on the reference count
+        match self.as_paths.entry(as_path){
+            Entry::Occupied(mut o) => {
+                *o.get_mut() += 1;
+                Arc::clone(o.key())
+            },
+            Entry::Vacant(v) => {
+                let as_path = Arc::clone(v.key());
+                v.insert(1);
+                as_path
+            }
+        }
+    }
+
+    fn release_as_path(&mut self, as_path: ASPath){
+        // called once for every route using as_path that leaves the rib
+        let uses = match self.as_paths.get_mut(&as_path){
+            Some(uses) => uses,
+            None => return
+        };
+        *uses -= 1;
+        if *uses == 0{
+            self.as_paths.remove(&as_path);
+        }
+    }
+
+    fn prepend_as(&self, as_path: &[u32]) -> ASPath{
+        [&[self.router_as], as_path].concat().into()
+    }
+
     pub async fn process_update(
         &mut self,
         port: u32,
         prefix: IPPrefix,
         nexthop: Ipv4Addr,
-        as_path: Vec<u32>,
+        as_path: ASPath,
         med: u32,
         router_id: u32
     ) {
         
-        let info = self.router_info.lock().await;
-        let name = info.name.clone();
-        let ip = info.ip;
-        let pref = info.bgp_links.get(&port).unwrap().0;
-        let current_as = info.router_as;
-        drop(info);
-        if as_path.contains(&current_as){
+        if as_path.contains(&self.router_as){
+            // the peer now uses a path through us, this implicitly withdraws its previous route
+            let previous = self.routes.get(&prefix).and_then(|rib| rib.paths.get(&(nexthop, router_id)));
+            if let Some(previous) = previous{
+                let previous_path = Arc::clone(&previous.as_path);
+                self.process_withdraw(port, prefix, nexthop, previous_path, router_id).await;
+            }
             return;
         }
-        self.prefixes.insert(prefix, prefix);
-        self.logger.borrow().log(Source::BGP, format!("Router {} received bgp update on port {} for prefix {} with nexthop = {}, AS path = {:?}, med = {}", name, port, prefix, nexthop, as_path, med)).await;
+        let pref = self.router_info.lock().await.bgp_links.get(&port).unwrap().0;
+        if self.logger.enabled(&Source::BGP){
+            self.logger.borrow().log(Source::BGP, format!("Router {} received bgp update on port {} for prefix {} with nexthop = {}, AS path = {:?}, med = {}", self.name, port, prefix, nexthop, as_path, med)).await;
+        }
+        let as_path = self.intern_as_path(as_path);
         let route = BGPRoute{prefix, nexthop, as_path, pref, med, source: RouteSource::EBGP, router_id};
+        self.insert_route(route).await;
+    }
 
-        let previous_best = self.decision_process(prefix).await;
+    async fn insert_route(&mut self, route: BGPRoute){
+        let prefix = route.prefix;
+        let previous_best = self.best_route(prefix);
 
-        let routes = match self.routes.entry(prefix) {
+        let rib = match self.routes.entry(prefix) {
             Entry::Occupied(o) => o.into_mut(),
-            Entry::Vacant(v) => v.insert(HashSet::new()),
+            Entry::Vacant(v) => {
+                self.prefixes.insert(prefix, prefix);
+                v.insert(BGPRib::default())
+            },
         };
 
-        routes.insert(route);
-
-        let best = self.decision_process(prefix).await;
-
-        if previous_best != best{
-            if let Some(previous_best_route) = previous_best{
-                self.send_withdraw(previous_best_route.prefix, ip, previous_best_route.as_path.clone()).await;
-                if previous_best_route.source != RouteSource::IBGP{
-                    self.send_ibgp_withdraw(previous_best_route.prefix, previous_best_route.as_path).await;
+        let replaced = rib.paths.insert((route.nexthop, route.router_id), route.clone());
+
+        // compare the new route with the current best on preference and AS path length,
+        // the full decision process is only needed when they tie or when the best itself got replaced
+        let best = match &previous_best{
+            None => Some(route),
+            Some(previous) if replaced.as_ref() == Some(previous) => self.refresh_best(prefix).await,
+            Some(previous) => {
+                let key = |route: &BGPRoute| (route.pref, Reverse(route.as_path.len()));
+                match key(&route).cmp(&key(previous)){
+                    Ordering::Greater => Some(route),
+                    Ordering::Less => previous_best.clone(),
+                    Ordering::Equal => self.refresh_best(prefix).await
                 }
             }
-            let best = best.unwrap();
-            self.logger.borrow().log(Source::BGP, format!("Router {} has new best route ({}) to reach prefix {}", name, best, best.prefix)).await;
-            self.install_route(best.clone()).await;
-            self.send_update(best.prefix, ip, best.as_path.clone(), best.pref).await;
-            self.send_ibgp_update(best.prefix, best.as_path, best.pref, best.med).await;
+        };
+        if let Some(rib) = self.routes.get_mut(&prefix){
+            rib.best = best.clone();
         }
-    }
 
-    pub async fn process_withdraw(&mut self, port: u32, prefix: IPPrefix, nexthop: Ipv4Addr, as_path: Vec<u32>, router_id: u32) {
-        let info = self.router_info.lock().await;
-        let name = info.name.clone();
-        let current_as = info.router_as;
-        let ip = info.ip;
-        drop(info);
-        if as_path.contains(&current_as){
-            return;
+        if previous_best != best{
+            self.best_route_changed(prefix, previous_best, best).await;
         }
-        self.logger.borrow().log(Source::BGP, format!("Router {} received bgp withdraw on port {} for prefix {} with nexthop = {}, AS path = {:?}", name, port, prefix, nexthop, as_path)).await;
-    
-        let previous_best = self.decision_process(prefix).await;
-
-        let routes = self.routes.get(&prefix);
+        if let Some(replaced) = replaced{
+            self.release_as_path(replaced.as_path);
+        }
+    }
 
-        if let None = routes{
+    pub async fn process_withdraw(&mut self, port: u32, prefix: IPPrefix, nexthop: Ipv4Addr, as_path: ASPath, router_id: u32) {
+        if as_path.contains(&self.router_as){
             return;
         }
-
-        let routes = routes.unwrap();
-
-        let mut new_routes = HashSet::new();
-        let mut best_removed = false;
-        for route in routes{
-            if route.nexthop == nexthop && route.router_id == router_id && route.as_path == as_path{
-                if let Some(r) = &previous_best{
-                    best_removed = best_removed || route.nexthop == r.nexthop && route.router_id == r.router_id && route.as_path == r.as_path ; 
-                }
-            }else{
-                new_routes.insert(route.clone());
-            }
+        if self.logger.enabled(&Source::BGP){
+            self.logger.borrow().log(Source::BGP, format!("Router {} received bgp withdraw on port {} for prefix {} with nexthop = {}, AS path = {:?}", self.name, port, prefix, nexthop, as_path)).await;
         }
+
+        self.remove_route(prefix, nexthop, as_path, router_id).await;
         
-        self.routes.insert(prefix, new_routes);
+    }
 
-        if best_removed{
-            let previous_best = previous_best.unwrap();
-            self.send_withdraw(prefix, ip, previous_best.as_path.clone()).await;
-            if previous_best.source == RouteSource::EBGP{
-                self.send_ibgp_withdraw(prefix, previous_best.as_path).await;
-            }
+    async fn remove_route(&mut self, prefix: IPPrefix, nexthop: Ipv4Addr, as_path: ASPath, router_id: u32){
+        let rib = match self.routes.get_mut(&prefix){
+            Some(rib) => rib,
+            None => return
+        };
 
-            let new_best = self.decision_process(prefix).await;
-            if let Some(new_best_route) = new_best{
-                self.logger.borrow().log(Source::BGP, format!("Router {} has new best route ({}) to reach prefix {}", name, new_best_route, new_best_route.prefix)).await;
-                self.install_route(new_best_route.clone()).await;
-                self.send_update(prefix, ip, new_best_route.as_path.clone(), new_best_route.pref).await;
-                if new_best_route.source != RouteSource::IBGP{
-                    self.send_ibgp_update(new_best_route.prefix, new_best_route.as_path, new_best_route.pref, new_best_route.med).await;
-                }
-            }
+        // the route is only removed if the withdraw matches what the peer announced
+        let removed = match rib.paths.entry((nexthop, router_id)){
+            Entry::Occupied(o) if *o.get().as_path == *as_path => o.remove(),
+            _ => return
+        };
+
+        let released = Arc::clone(&removed.as_path);
+        if rib.best.as_ref() == Some(&removed){
+            let previous_best = Some(removed);
+            let new_best = self.refresh_best(prefix).await;
+            self.best_route_changed(prefix, previous_best, new_best).await;
+        }else{
+            drop(removed);
         }
-        
+        if self.routes.get(&prefix).map_or(false, |rib| rib.paths.is_empty()){
+            // no route left, lookups now fall back on a shorter prefix
+            self.routes.remove(&prefix);
+            self.prefixes.remove(prefix);
+            self.igp_info.lock().await.routing_table.remove(&prefix);
+        }
+        drop(as_path);
+        self.release_as_path(released);
     }
 
     pub async fn process_update_ibgp(
@@ -187,190 +286,140 @@ impl BGPState {
         port: u32,
         prefix: IPPrefix,
         nexthop: Ipv4Addr,
-        as_path: Vec<u32>,
+        as_path: ASPath,
         pref: u32,
         med: u32,
         router_id: u32
     ){
-        let info = self.router_info.lock().await;
-        let name = info.name.clone();
-        let ip = info.ip;
-        drop(info);
-        self.prefixes.insert(prefix, prefix);
-        self.logger.borrow().log(Source::BGP, format!("Router {} received ibgp update on port {} for prefix {} with nexthop = {}, AS path = {:?}, med = {}", name, port, prefix, nexthop, as_path, med)).await;
+        if self.logger.enabled(&Source::BGP){
+            self.logger.borrow().log(Source::BGP, format!("Router {} received ibgp update on port {} for prefix {} with nexthop = {}, AS path = {:?}, med = {}", self.name, port, prefix, nexthop, as_path, med)).await;
+        }
+        let as_path = self.intern_as_path(as_path);
         let route = BGPRoute{prefix, nexthop, as_path, pref, med, source: RouteSource::IBGP, router_id};
+        self.insert_route(route).await;
+    }
 
-        let previous_best = self.decision_process(prefix).await;
-
-        let routes = match self.routes.entry(prefix) {
-            Entry::Occupied(o) => o.into_mut(),
-            Entry::Vacant(v) => v.insert(HashSet::new()),
-        };
-
-        routes.insert(route);
+    pub async fn process_withdraw_ibgp(&mut self, port: u32, prefix: IPPrefix, nexthop: Ipv4Addr, as_path: ASPath, router_id: u32) {
+        if self.logger.enabled(&Source::BGP){
+            self.logger.borrow().log(Source::BGP, format!("Router {} received ibgp withdraw on port {} for prefix {} with nexthop = {}, AS path = {:?}", self.name, port, prefix, nexthop, as_path)).await;
+        }
 
-        let best = self.decision_process(prefix).await;
+        self.remove_route(prefix, nexthop, as_path, router_id).await;
+    }
 
-        if previous_best != best{
-            if let Some(previous_best_route) = previous_best{
-                self.send_withdraw(previous_best_route.prefix, ip, previous_best_route.as_path.clone()).await;
-                if previous_best_route.source != RouteSource::IBGP{
-                    self.send_ibgp_withdraw(previous_best_route.prefix, previous_best_route.as_path).await;
-                }
+    pub async fn best_route_changed(&self, prefix: IPPrefix, previous_best: Option<BGPRoute>, best: Option<BGPRoute>){
+        if let Some(best) = &best{
+            if self.logger.enabled(&Source::BGP){
+                self.logger.borrow().log(Source::BGP, format!("Router {} has new best route ({}) to reach prefix {}", self.name, best, best.prefix)).await;
             }
-            let best = best.unwrap();
-            self.logger.borrow().log(Source::BGP, format!("Router {} has new best route ({}) to reach prefix {}", name, best, best.prefix)).await;
             self.install_route(best.clone()).await;
-            self.send_update(best.prefix, ip, best.as_path.clone(), best.pref).await;
-            // suppose fullmesh, no need to readvertise new best to other ibgp peers
         }
-    }
 
-    pub async fn process_withdraw_ibgp(&mut self, port: u32, prefix: IPPrefix, nexthop: Ipv4Addr, as_path: Vec<u32>, router_id: u32) {
+        // an update implicitly replaces the route previously sent to a neighbor,
+        // a withdraw is only needed when the new best isn't exported to it
         let info = self.router_info.lock().await;
-        let name = info.name.clone();
-        let ip = info.ip;
-        drop(info);
-        self.logger.borrow().log(Source::BGP, format!("Router {} received ibgp withdraw on port {} for prefix {} with nexthop = {}, AS path = {:?}", name, port, prefix, nexthop, as_path)).await;
-    
-        let previous_best = self.decision_process(prefix).await;
-
-        let routes = self.routes.get(&prefix);
-
-        if let None = routes{
-            return;
-        }
-
-        let routes = routes.unwrap();
-
-        let mut new_routes = HashSet::new();
-        let mut best_removed = false;
-        for route in routes{
-            if route.nexthop == nexthop && route.router_id == router_id && route.as_path == as_path{
-                if let Some(r) = &previous_best{
-                    best_removed = best_removed || route.nexthop == r.nexthop && route.router_id == r.router_id && route.as_path == r.as_path ; 
-                }
-            }else{
-                new_routes.insert(route.clone());
+        let from_customer = |route: &Option<BGPRoute>| route.as_ref().map_or(false, |route| route.pref == CUSTOMER_PREF);
+        let ports: Box<dyn Iterator<Item = &u32> + Send + '_> = if from_customer(&best) || from_customer(&previous_best){
+            Box::new(info.bgp_links.keys())
+        }else{
+            // routes from peers/providers only concern the customers
+            Box::new(info.customer_links.iter())
+        };
+        // the paths are built once and shared by the messages sent on every port
+        let best_path = best.as_ref().map(|best| self.prepend_as(&best.as_path));
+        let previous_path = previous_best.as_ref().map(|previous| self.prepend_as(&previous.as_path));
+        for port in ports {
+            let (pref, med) = info.bgp_links.get(port).unwrap();
+            let (_, sender) = info.neighbors_links.get(port).unwrap();
+            let message = match (&best, &previous_best){
+                (Some(best), _) if Self::exported(best.pref, *pref) => {
+                    BGPMessage::Update(prefix, self.ip, Arc::clone(best_path.as_ref().unwrap()), *med, self.id)
+                },
+                (_, Some(previous)) if Self::exported(previous.pref, *pref) => {
+                    BGPMessage::Withdraw(prefix, self.ip, Arc::clone(previous_path.as_ref().unwrap()), self.id)
+                },
+                _ => continue
+            };
+            if self.logger.enabled(&Source::BGP){
+                self.logger.borrow().log(Source::BGP, format!("Router {} has sent {} on port {}", self.name, message, port)).await;
             }
+            self.pending_bgp.fetch_add(1, atomic::Ordering::SeqCst);
+            sender
+                .send(Message::BGP(message))
+                .await
+                .expect("Failed to send bgp message");
         }
-        
-        self.routes.insert(prefix, new_routes);
-
-        if best_removed{
-            let previous_best = previous_best.unwrap();
-            self.send_withdraw(prefix, ip, previous_best.as_path.clone()).await;
-            if previous_best.source == RouteSource::EBGP{
-                self.send_ibgp_withdraw(prefix, previous_best.as_path).await;
-            }
+        drop(info);
 
-            let new_best = self.decision_process(prefix).await;
-            if let Some(new_best_route) = new_best{
-                self.logger.borrow().log(Source::BGP, format!("Router {} has new best route ({}) to reach prefix {}", name, new_best_route, new_best_route.prefix)).await;
-                self.install_route(new_best_route.clone()).await;
-                self.send_update(prefix, ip, new_best_route.as_path.clone(), new_best_route.pref).await;
-                if new_best_route.source != RouteSource::IBGP{
-                    self.send_ibgp_update(new_best_route.prefix, new_best_route.as_path, new_best_route.pref, new_best_route.med).await;
-                }
-            }
+        // suppose fullmesh, only routes learned over eBGP are advertised to ibgp peers
+        match (best, previous_best){
+            (Some(best), _) if best.source == RouteSource::EBGP => {
+                self.send_ibgp_update(prefix, best.as_path, best.pref, best.med).await;
+            },
+            (_, Some(previous)) if previous.source == RouteSource::EBGP => {
+                self.send_ibgp_withdraw(prefix, previous.as_path).await;
+            },
+            _ => ()
         }
     }
 
-    pub async fn distance_nexthop(&self, nexthop: Ipv4Addr) -> u32{
-        let igp_info = &self.igp_info.lock().await;
-        let prefix = igp_info.prefixes.longest_match(nexthop);
-        if prefix.is_none(){
-            return u32::max_value();
-        }
-        let prefix = prefix.unwrap();
-        match igp_info.routing_table.get(&prefix){
-            Some((_, distance)) => *distance,
-            None => u32::max_value(),
-        }
+    fn exported(pref_from: u32, pref_to: u32) -> bool{
+        // send routes from peer/providers only to customers
+        pref_from == CUSTOMER_PREF || pref_to == CUSTOMER_PREF
     }
 
-    pub async fn decision_process(&self, prefix: IPPrefix) -> Option<BGPRoute>{
-        let routes = self.routes.get(&prefix);
-
-        if routes.is_none(){
-            return None;
-        }
-
-        let routes = routes.unwrap();
-
-        if routes.is_empty(){
-            return None;
-        }
-
-        let mut best_pref = 0;
-        let mut best_path_len = usize::max_value();
-        for route in routes{
-            if best_pref != route.pref{
-                if route.pref > best_pref{
-                    best_pref = route.pref;
-                    best_path_len = route.as_path.len();
-                }
-            }else{
-                best_path_len = usize::min(route.as_path.len(), best_path_len);
-            }
-        }
-
-        let mut map = HashMap::new();
-        for route in routes{
-            if route.pref != best_pref || route.as_path.len() != best_path_len{
-                continue;
-            }
-            let map_entry = match map.entry(route.as_path[0]) {
-                Entry::Occupied(o) => o.into_mut(),
-                Entry::Vacant(v) => v.insert(vec![]),
-            };
+    pub async fn distance_nexthop(&self, nexthop: Ipv4Addr) -> u32{
+        self.igp_info.lock().await.get_distance(nexthop).unwrap_or(u32::max_value())
+    }
 
-            if map_entry.len() == 0{
-                map_entry.push(route);
-            }else if map_entry[0].med > route.med{
-                map_entry.clear();
-                map_entry.push(route);
-            }else if map_entry[0].med == route.med{
-                map_entry.push(route);
-            }
-        }
+    pub fn best_route(&self, prefix: IPPrefix) -> Option<BGPRoute>{
+        self.routes.get(&prefix)?.best.clone()
+    }
 
-        let mut routes: Vec<&BGPRoute> = vec![];
-        for route_vec in map.values(){
-            routes.extend(route_vec.iter());
+    pub async fn refresh_best(&mut self, prefix: IPPrefix) -> Option<BGPRoute>{
+        let best = self.decision_process(prefix).await;
+        if let Some(rib) = self.routes.get_mut(&prefix){
+            rib.best = best.clone();
         }
+        best
+    }
 
-        let mut best_route = routes[0];
-        
-        for route in routes{
-            if best_route.source != route.source{
-                if best_route.source == RouteSource::IBGP && route.source == RouteSource::EBGP{
-                    best_route = route;
-                }
-            }
-            else if best_route.source == RouteSource::IBGP && self.distance_nexthop(route.nexthop).await != self.distance_nexthop(best_route.nexthop).await{
-                if self.distance_nexthop(route.nexthop).await < self.distance_nexthop(best_route.nexthop).await{
-                    best_route = route;
-                }
-            }else if route.router_id < best_route.router_id{
-                    best_route = route;
+    pub async fn igp_changed(&mut self){
+        // the best route is cached, but the distance to the nexthop breaks ties between ibgp routes:
+        // recompute it for the prefixes where the igp can make a difference
+        let prefixes: Vec<IPPrefix> = self.routes.iter()
+            .filter(|(_, rib)| rib.paths.values().filter(|route| route.source == RouteSource::IBGP).count() > 1)
+            .map(|(prefix, _)| *prefix)
+            .collect();
+        for prefix in prefixes{
+            let previous_best = self.best_route(prefix);
+            let best = self.refresh_best(prefix).await;
+            if previous_best != best{
+                self.best_route_changed(prefix, previous_best, best).await;
             }
         }
+    }
 
-        Some(best_route.clone())
+    pub async fn decision_process(&self, prefix: IPPrefix) -> Option<BGPRoute>{
+        let routes: Vec<&BGPRoute> = self.routes.get(&prefix)?.paths.values().collect();
+        let igp_info = self.igp_info.lock().await;
+        let best = pick_best(&routes, |nexthop| igp_info.get_distance(nexthop).unwrap_or(u32::max_value()))?;
+        Some(routes[best].clone())
     }
 
-    pub async fn send_update(&self, prefix: IPPrefix, nexthop: Ipv4Addr, mut as_path: Vec<u32>, pref_from: u32) {
+    pub async fn send_update(&self, prefix: IPPrefix, nexthop: Ipv4Addr, as_path: &[u32], pref_from: u32) {
         let info = self.router_info.lock().await;
-        as_path.insert(0, info.router_as);
+        let as_path = self.prepend_as(as_path);
         for (port, (pref, med)) in info.bgp_links.iter() {
             let (_, sender) = info.neighbors_links.get(port).unwrap();
-            if pref_from != 150 && *pref != 150{
-                // send routes from peer/providers only to customers
+            if !Self::exported(pref_from, *pref){
                 continue;
             }
-            let message = BGPMessage::Update(prefix.clone(), nexthop, as_path.clone(), *med, info.id);
-            self.logger.borrow().log(Source::BGP, format!("Router {} has sent {} on port {}", info.name, message, port)).await;
+            let message = BGPMessage::Update(prefix.clone(), nexthop, as_path.clone(), *med, self.id);
+            if self.logger.enabled(&Source::BGP){
+                self.logger.borrow().log(Source::BGP, format!("Router {} has sent {} on port {}", self.name, message, port)).await;
+            }
+            self.pending_bgp.fetch_add(1, atomic::Ordering::SeqCst);
             sender
                 .send(Message::BGP(message))
                 .await
@@ -378,74 +427,304 @@ impl BGPState {
         }
     }
 
-    pub async fn send_ibgp_update(&self, prefix: IPPrefix, as_path: Vec<u32>, pref_from: u32, med: u32) {
+    pub async fn send_ibgp_update(&self, prefix: IPPrefix, as_path: ASPath, pref_from: u32, med: u32) {
         let igp_state = self.igp_info.lock().await;
-        let info =  self.router_info.lock().await;
-        let peers = info.ibgp_peers.clone();
-        let self_ip = info.ip;
-        let self_id = info.id;
-        let name = info.name.clone();
-        drop(info);
+        let peers = self.router_info.lock().await.ibgp_peers.clone();
+        let self_ip = self.ip;
+        let self_id = self.id;
         for peer_addr in peers {
             let ibgp_message = IBGPMessage::Update(prefix.clone(), self_ip, as_path.clone(), pref_from, med, self_id);
-            self.logger.borrow().log(Source::BGP, format!("Router {} has sent iBGP message {} to peer {}", name, ibgp_message, peer_addr)).await;
+            if self.logger.enabled(&Source::BGP){
+                self.logger.borrow().log(Source::BGP, format!("Router {} has sent iBGP message {} to peer {}", self.name, ibgp_message, peer_addr)).await;
+            }
             let message = IP{
                 src: self_ip, 
                 dest: peer_addr.clone(), 
                 content: Content::IBGP(ibgp_message)
             };
-            igp_state.send_message(peer_addr.clone(), message).await;
-        }
-    }
-
-    pub async fn send_withdraw(&self, prefix: IPPrefix, nexthop: Ipv4Addr, mut as_path: Vec<u32>) {
-        let info = self.router_info.lock().await;
-        as_path.insert(0, info.router_as);
-        for (port, _) in info.bgp_links.iter() {
-            let (_, sender) = info.neighbors_links.get(port).unwrap();
-            let message = BGPMessage::Withdraw(prefix.clone(), nexthop, as_path.clone(), info.id);
-            self.logger.borrow().log(Source::BGP, format!("Router {} has sent {} on port {}", info.name, message, port)).await;
-            sender
-                .send(Message::BGP(message))
-                .await
-                .expect("Failed to send bgp message");
+            // counted before sending, the peer could process it before we return
+            self.pending_bgp.fetch_add(1, atomic::Ordering::SeqCst);
+            if !igp_state.send_message(peer_addr.clone(), message).await{
+                self.pending_bgp.fetch_sub(1, atomic::Ordering::SeqCst);
+            }
         }
     }
 
-    pub async fn send_ibgp_withdraw(&self, prefix: IPPrefix, as_path: Vec<u32>) {
+    pub async fn send_ibgp_withdraw(&self, prefix: IPPrefix, as_path: ASPath) {
         let igp_state = self.igp_info.lock().await;
-        let info =  self.router_info.lock().await;
-        let peers = info.ibgp_peers.clone();
-        let self_ip = info.ip;
-        let self_id = info.id;
-        let name = info.name.clone();
-        drop(info);
+        let peers = self.router_info.lock().await.ibgp_peers.clone();
+        let self_ip = self.ip;
+        let self_id = self.id;
         for peer_addr in peers {
             let ibgp_message = IBGPMessage::Withdraw(prefix.clone(), self_ip, as_path.clone(), self_id);
-            self.logger.borrow().log(Source::BGP, format!("Router {} has sent iBGP message {} to peer {}", name, ibgp_message, peer_addr)).await;
+            if self.logger.enabled(&Source::BGP){
+                self.logger.borrow().log(Source::BGP, format!("Router {} has sent iBGP message {} to peer {}", self.name, ibgp_message, peer_addr)).await;
+            }
             let message = IP{
                 src: self_ip, 
                 dest: peer_addr.clone(), 
                 content: Content::IBGP(ibgp_message)
             };
-            igp_state.send_message(peer_addr.clone(), message).await;
+            // counted before sending, the peer could process it before we return
+            self.pending_bgp.fetch_add(1, atomic::Ordering::SeqCst);
+            if !igp_state.send_message(peer_addr.clone(), message).await{
+                self.pending_bgp.fetch_sub(1, atomic::Ordering::SeqCst);
+            }
         }
     }
 
 
     pub async fn announce_prefix(&self) {
+        if self.logger.enabled(&Source::BGP){
+            self.logger.borrow().log(Source::BGP, format!("Router {} announcing its prefix {}", self.name, self.ip)).await;
+        }
+        self.send_update(self.own_prefix(), self.ip, &[], CUSTOMER_PREF).await;
+    }
+
+    pub async fn withdraw_prefix(&self) {
+        if self.logger.enabled(&Source::BGP){
+            self.logger.borrow().log(Source::BGP, format!("Router {} withdrawing its prefix {}", self.name, self.ip)).await;
+        }
+        // the prefix was announced to every neighbor
+        let prefix = self.own_prefix();
+        let as_path = self.prepend_as(&[]);
         let info = self.router_info.lock().await;
-        self.logger.borrow().log(Source::BGP, format!("Router {} announcing its prefix {}", info.name, info.ip)).await;
-        let ip = info.ip;
-        drop(info);
-        let octets = ip.octets();
-        let prefix = IPPrefix{ip: Ipv4Addr::new(octets[0], octets[1], octets[2], 0), prefix_len: 24};
-        self.send_update(prefix, ip, vec![], 150).await;
+        for port in info.bgp_links.keys() {
+            let (_, sender) = info.neighbors_links.get(port).unwrap();
+            let message = BGPMessage::Withdraw(prefix, self.ip, Arc::clone(&as_path), self.id);
+            if self.logger.enabled(&Source::BGP){
+                self.logger.borrow().log(Source::BGP, format!("Router {} has sent {} on port {}", self.name, message, port)).await;
+            }
+            self.pending_bgp.fetch_add(1, atomic::Ordering::SeqCst);
+            sender
+                .send(Message::BGP(message))
+                .await
+                .expect("Failed to send bgp message");
+        }
+    }
+
+    fn own_prefix(&self) -> IPPrefix{
+        let octets = self.ip.octets();
+        IPPrefix{ip: Ipv4Addr::new(octets[0], octets[1], octets[2], 0), prefix_len: 24}
     }
 
     pub async fn get_nexthop(&self, dest: Ipv4Addr) -> Option<Ipv4Addr>{
         let prefix = self.prefixes.longest_match(dest)?;
-        let best_route = self.decision_process(prefix).await?;
+        let best_route = self.best_route(prefix)?;
         Some(best_route.nexthop)
     }
 }
+
+// index of the best route, igp_distance gives the distance to the nexthop of ibgp routes
+pub fn pick_best<F: Fn(Ipv4Addr) -> u32>(routes: &[&BGPRoute], igp_distance: F) -> Option<usize>{
+    // highest preference, then shortest AS path
+    let best = routes.iter()
+        .map(|route| (route.pref, Reverse(route.as_path.len())))
+        .max()?;
+    let candidate = |route: &BGPRoute| (route.pref, Reverse(route.as_path.len())) == best;
+
+    // med is only compared between routes received from the same AS
+    let lowest_med = |route: &BGPRoute| !routes.iter()
+        .any(|other| candidate(other) && other.as_path[0] == route.as_path[0] && other.med < route.med);
+
+    // then ebgp over ibgp, closest nexthop for ibgp routes, and lowest router id
+    (0..routes.len())
+        .filter(|&i| candidate(routes[i]) && lowest_med(routes[i]))
+        .min_by_key(|&i| match routes[i].source {
+            RouteSource::EBGP => (0, 0, routes[i].router_id),
+            RouteSource::IBGP => (1, igp_distance(routes[i].nexthop), routes[i].router_id),
+        })
+}
+
+#[cfg(test)]
+mod tests {
+    use std::{collections::HashMap, net::Ipv4Addr, sync::{atomic::AtomicUsize, Arc}};
+    use tokio::sync::{mpsc::{channel, Receiver}, Mutex};
+
+    use crate::network::{ip_prefix::IPPrefix, logger::Logger, messages::Message, protocols::{arp::ArpState, ospf::OSPFState}, router::RouterInfo, utils::MacAddress};
+    use super::{pick_best, ASPath, BGPRoute, BGPState, RouteSource, CUSTOMER_PREF, PEER_PREF};
+
+    // bgp state of a router without any link, its own address is used as nexthop so that routes can be installed
+    fn bgp_state() -> BGPState{
+        let ip = Ipv4Addr::new(10, 0, 1, 1);
+        let logger = Logger::start_test();
+        let router_info = Arc::new(Mutex::new(RouterInfo{
+            name: "r1".into(),
+            id: 1,
+            router_as: 1,
+            ip,
+            mac_address: MacAddress{id: 1},
+            neighbors_links: HashMap::new(),
+            igp_links: HashMap::new(),
+            bgp_links: HashMap::new(),
+            customer_links: vec![],
+            ibgp_peers: vec![]
+        }));
+        let arp_state = Arc::new(Mutex::new(ArpState::new(Arc::clone(&router_info), logger.clone())));
+        let igp_state = Arc::new(Mutex::new(OSPFState::new(ip, logger.clone(), Arc::clone(&router_info), arp_state)));
+        BGPState::new("r1".into(), 1, 1, ip, router_info, igp_state, logger, Arc::new(AtomicUsize::new(0)))
+    }
+
+    fn route(as_path: Vec<u32>, pref: u32, med: u32, router_id: u32, source: RouteSource) -> BGPRoute{
+        BGPRoute{
+            prefix: "10.0.0.0/24".parse().unwrap(),
+            nexthop: format!("10.0.0.{}", router_id).parse().unwrap(),
+            as_path: as_path.into(),
+            pref,
+            med,
+            router_id,
+            source
+        }
+    }
+
+    #[test]
+    fn test_pick_best() {
+        let routes = vec![
+            route(vec![2, 4], 100, 0, 2, RouteSource::EBGP),
+            route(vec![3, 5, 4], 150, 0, 3, RouteSource::EBGP),
+            route(vec![6, 4], 150, 0, 6, RouteSource::EBGP),
+        ];
+        let routes: Vec<&BGPRoute> = routes.iter().collect();
+        assert_eq!(pick_best(&routes, |_| 0), Some(2)); // highest pref, then shortest path
+        assert_eq!(pick_best(&[], |_| 0), None);
+    }
+
+    #[test]
+    fn test_pick_best_med() {
+        let routes = vec![
+            route(vec![2, 4], 100, 5, 1, RouteSource::EBGP),
+            route(vec![2, 4], 100, 1, 7, RouteSource::EBGP),
+            route(vec![3, 4], 100, 0, 8, RouteSource::EBGP),
+        ];
+        let routes: Vec<&BGPRoute> = routes.iter().collect();
+        // med of AS3 isn't compared with AS2, lowest router id between the two remaining
+        assert_eq!(pick_best(&routes, |_| 0), Some(1));
+    }
+
+    #[test]
+    fn test_pick_best_ibgp() {
+        let routes = vec![
+            route(vec![2, 4], 100, 0, 1, RouteSource::IBGP),
+            route(vec![3, 4], 100, 0, 2, RouteSource::IBGP),
+            route(vec![5, 4], 100, 0, 9, RouteSource::EBGP),
+        ];
+        let routes: Vec<&BGPRoute> = routes.iter().collect();
+        assert_eq!(pick_best(&routes, |_| 0), Some(2)); // ebgp over ibgp
+        assert_eq!(pick_best(&routes[..2], |nexthop| if nexthop.octets()[3] == 1 { 10 } else { 1 }), Some(1)); // closest nexthop
+    }
+
+    async fn set_distance(state: &BGPState, ip: Ipv4Addr, distance: u32){
+        let mut igp_state = state.igp_info.lock().await;
+        let prefix = IPPrefix{ip, prefix_len: 32};
+        igp_state.routing_table.insert(prefix, (1, distance));
+        igp_state.prefixes.insert(prefix, prefix);
+    }
+
+    // ebgp neighbor with address ip on port, returns what the router sends to it
+    async fn add_neighbor(state: &BGPState, port: u32, pref: u32, ip: Ipv4Addr) -> Receiver<Message>{
+        let (tx, rx) = channel(1024);
+        let (_, unused) = channel(1);
+        let mut info = state.router_info.lock().await;
+        info.neighbors_links.insert(port, (Arc::new(Mutex::new(unused)), tx));
+        info.bgp_links.insert(port, (pref, 0));
+        if pref == CUSTOMER_PREF{
+            info.customer_links.push(port);
+        }
+        drop(info);
+        set_distance(state, ip, 1).await;
+        rx
+    }
+
+    fn sent(receiver: &mut Receiver<Message>) -> Vec<String>{
+        let mut messages = vec![];
+        while let Ok(message) = receiver.try_recv(){
+            messages.push(match message{
+                Message::BGP(bgp) => bgp.to_string(),
+                message => format!("{:?}", message)
+            });
+        }
+        messages
+    }
+
+    #[tokio::test]
+    async fn test_looped_update() {
+        let mut state = bgp_state();
+        let r2 = Ipv4Addr::new(10, 0, 2, 2);
+        add_neighbor(&state, 1, PEER_PREF, r2).await;
+        let prefix = "10.0.3.0/24".parse().unwrap();
+
+        state.process_update(1, prefix, r2, vec![2, 3].into(), 0, 2).await;
+        assert_eq!(state.get_nexthop(Ipv4Addr::new(10, 0, 3, 1)).await, Some(r2));
+
+        // the peer now reaches the prefix through us, its previous route is implicitly withdrawn
+        state.process_update(1, prefix, r2, vec![2, 1, 3].into(), 0, 2).await;
+        assert!(state.routes.is_empty());
+        assert_eq!(state.get_nexthop(Ipv4Addr::new(10, 0, 3, 1)).await, None);
+    }
+
+    #[tokio::test]
+    async fn test_best_route_replaced() {
+        let mut state = bgp_state();
+        let (r2, r3) = (Ipv4Addr::new(10, 0, 2, 2), Ipv4Addr::new(10, 0, 3, 3));
+        let mut customer = add_neighbor(&state, 1, CUSTOMER_PREF, r2).await;
+        let mut peer = add_neighbor(&state, 2, PEER_PREF, r3).await;
+        let prefix = "10.0.5.0/24".parse().unwrap();
+
+        state.process_update(2, prefix, r3, vec![3, 5].into(), 0, 3).await;
+        assert_eq!(sent(&mut customer), vec!["UPDATE(prefix=10.0.5.0/24, nexthop=10.0.1.1, as_path=AS1:AS3:AS5, med=0, router_id=1)"]);
+        assert!(sent(&mut peer).is_empty()); // routes from peers are only exported to customers
+
+        // a route from a customer is exported to everyone, the update replaces the previous one without a withdraw
+        state.process_update(1, prefix, r2, vec![2, 5].into(), 0, 2).await;
+        assert_eq!(sent(&mut customer), vec!["UPDATE(prefix=10.0.5.0/24, nexthop=10.0.1.1, as_path=AS1:AS2:AS5, med=0, router_id=1)"]);
+        assert_eq!(sent(&mut peer), vec!["UPDATE(prefix=10.0.5.0/24, nexthop=10.0.1.1, as_path=AS1:AS2:AS5, med=0, router_id=1)"]);
+
+        // back to the route of the peer, only the peer that doesn't receive it gets a withdraw
+        state.process_withdraw(1, prefix, r2, vec![2, 5].into(), 2).await;
+        assert_eq!(sent(&mut customer), vec!["UPDATE(prefix=10.0.5.0/24, nexthop=10.0.1.1, as_path=AS1:AS3:AS5, med=0, router_id=1)"]);
+        assert_eq!(sent(&mut peer), vec!["WITHDRAW(prefix=10.0.5.0/24, nexthop=10.0.1.1, as_path=AS1:AS2:AS5, router_id=1)"]);
+    }
+
+    #[tokio::test]
+    async fn test_as_paths_released() {
+        let mut state = bgp_state();
+        let nexthop = state.ip;
+        let p2 = "10.0.2.0/24".parse().unwrap();
+        let p3 = "10.0.3.0/24".parse().unwrap();
+        let path = |as_path: &[u32]| -> ASPath { as_path.into() };
+
+        state.process_update_ibgp(0, p2, nexthop, path(&[2, 6, 1]), 100, 0, 5).await;
+        state.process_update_ibgp(0, p3, nexthop, path(&[2, 1]), 100, 0, 5).await;
+        assert_eq!(state.as_paths.len(), 2);
+
+        // the replaced path isn't used anymore, the shared one is counted once per route
+        state.process_update_ibgp(0, p2, nexthop, path(&[2, 1]), 100, 0, 5).await;
+        assert_eq!(state.as_paths.len(), 1);
+        assert_eq!(state.as_paths.get(&path(&[2, 1])), Some(&2));
+
+        state.process_withdraw_ibgp(0, p2, nexthop, path(&[2, 1]), 5).await;
+        assert_eq!(state.as_paths.get(&path(&[2, 1])), Some(&1));
+        state.process_withdraw_ibgp(0, p3, nexthop, path(&[2, 1]), 5).await;
+        assert!(state.as_paths.is_empty());
+    }
+
+    #[tokio::test]
+    async fn test_igp_changed() {
+        let mut state = bgp_state();
+        let (r2, r3) = (Ipv4Addr::new(10, 0, 1, 2), Ipv4Addr::new(10, 0, 1, 3));
+        let prefix = "10.0.2.0/24".parse().unwrap();
+        let dest = Ipv4Addr::new(10, 0, 2, 1);
+        set_distance(&state, r2, 1).await;
+        set_distance(&state, r3, 5).await;
+
+        state.process_update_ibgp(0, prefix, r2, vec![2].into(), 100, 0, 2).await;
+        state.process_update_ibgp(0, prefix, r3, vec![2].into(), 100, 0, 3).await;
+        assert_eq!(state.get_nexthop(dest).await, Some(r2));
+
+        // the cached best route only follows the igp once told that it changed
+        set_distance(&state, r2, 10).await;
+        assert_eq!(state.get_nexthop(dest).await, Some(r2));
+        state.igp_changed().await;
+        assert_eq!(state.get_nexthop(dest).await, Some(r3));
+    }
+}
\ No newline at end of file
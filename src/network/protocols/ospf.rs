@@ -50,11 +50,14 @@ impl OSPFState{
         }
     }
 
-    pub async fn send_message(&self, nexthop: Ipv4Addr, content: IP){
+    pub async fn send_message(&self, nexthop: Ipv4Addr, content: IP) -> bool{
         if let Some((port, mac)) = self.get_port_mac(nexthop).await{
             let info_router = self.router_info.lock().await;
             let (_, sender) = info_router.neighbors_links.get(&port).unwrap();
             sender.send(Message::EthernetFrame(mac, content)).await.expect("Failed to send ethernet frame");
+            true
+        }else{
+            false
         }
     }
 
@@ -79,15 +82,26 @@ impl OSPFState{
         Some(*port)
     }
 
-    pub async fn process_ospf(&mut self, ospf: OSPFMessage, port: u32){
+    pub fn get_distance(&self, ip: Ipv4Addr) -> Option<u32>{
+        let prefix = self.prefixes.longest_match(ip)?;
+        let (_, distance) = self.routing_table.get(&prefix)?;
+        Some(*distance)
+    }
+
+    // returns whether the routing table changed
+    pub async fn process_ospf(&mut self, ospf: OSPFMessage, port: u32) -> bool{
         match ospf{
-            Hello => self.send_hello_reply(port).await,
+            Hello => {
+                self.send_hello_reply(port).await;
+                false
+            },
             LSP(from, seq, neighbors) => self.process_lsp(from, seq, neighbors).await,
             HelloReply(ip) => self.process_hello_reply(ip, port).await,
         }
     }
 
-    pub async fn shortest_path(&mut self){
+    pub async fn shortest_path(&mut self) -> bool{
+        let mut changed = false;
         let mut visited = HashSet::new();
         let mut pq = BinaryHeap::new();
 
@@ -101,7 +115,7 @@ impl OSPFState{
             if visited.contains(&p.ip.ip){
                 continue;
             }
-            self.routing_table.insert(p.ip, (p.port, p.distance));
+            changed |= self.routing_table.insert(p.ip, (p.port, p.distance)) != Some((p.port, p.distance));
             self.prefixes.insert(p.ip, p.ip);
             visited.insert(p.ip.ip);
             let neighs = self.topo.get(&p.ip.ip);
@@ -111,12 +125,15 @@ impl OSPFState{
                 }
             }
         }
-        self.logger.log(Source::OSPF, format!("Router {} has updated its routing table : {:?}", self.get_name().await, self.routing_table)).await;
+        if self.logger.enabled(&Source::OSPF){
+            self.logger.log(Source::OSPF, format!("Router {} has updated its routing table : {:?}", self.get_name().await, self.routing_table)).await;
+        }
+        changed
     }
 
-    pub async fn process_lsp(&mut self, from: Ipv4Addr, seq: u32, neighbors: HashSet<(u32, IPPrefix)>){
+    pub async fn process_lsp(&mut self, from: Ipv4Addr, seq: u32, neighbors: HashSet<(u32, IPPrefix)>) -> bool{
         if self.received_lsp.contains(&(from, seq)){
-            return;
+            return false;
         }
         self.received_lsp.insert((from, seq));
         let values = match self.topo.entry(from) {
@@ -125,22 +142,25 @@ impl OSPFState{
         };
 
         values.extend(neighbors.iter());
-        self.shortest_path().await;
+        let changed = self.shortest_path().await;
 
         self.send_lsp(OSPFMessage::LSP(from, seq, neighbors)).await; // flood
+        changed
     }
 
-    pub async fn process_hello_reply(&mut self, ip: IPPrefix, port: u32){
+    pub async fn process_hello_reply(&mut self, ip: IPPrefix, port: u32) -> bool{
         if self.get_ip().await == ip.ip{
-            return;
+            return false;
         }
         let map = self.get_igp_neighbors().await;
         let (_, cost) = map.get(&port).unwrap();
         if self.direct_neighbors.contains(&(*cost, port, ip)){
-            return;
+            return false;
         }
         self.direct_neighbors.insert((*cost, port, ip));
-        self.logger.log(Source::OSPF, format!("Router {} has neighbors : {:?}", self.get_name().await, self.direct_neighbors)).await;
+        if self.logger.enabled(&Source::OSPF){
+            self.logger.log(Source::OSPF, format!("Router {} has neighbors : {:?}", self.get_name().await, self.direct_neighbors)).await;
+        }
         self.routing_table.insert(ip, (port, *cost));
 
         let values = match self.topo.entry(self.get_ip().await) {
@@ -150,7 +170,9 @@ impl OSPFState{
 
         values.insert((*cost, ip));
         
-        self.logger.log(Source::OSPF, format!("Router {} received prefix {} from neighbor on port {}", self.get_name().await, ip, port)).await;
+        if self.logger.enabled(&Source::OSPF){
+            self.logger.log(Source::OSPF, format!("Router {} received prefix {} from neighbor on port {}", self.get_name().await, ip, port)).await;
+        }
         let seq = self.lsp_seq;
         self.lsp_seq+=1;
         let mut neighs = HashSet::new();
@@ -159,11 +181,14 @@ impl OSPFState{
         }
         let ip = self.get_ip().await;
         self.send_lsp(OSPFMessage::LSP(ip, seq, neighs)).await;
+        true
     }
 
     pub async fn send_lsp(&mut self, lsp: OSPFMessage){
         for (port, (sender, _)) in self.get_igp_neighbors().await.iter() {
-            self.logger.log(Source::OSPF, format!("Router {} sending {:?} on port {}", self.get_name().await, lsp, port)).await;
+            if self.logger.enabled(&Source::OSPF){
+                self.logger.log(Source::OSPF, format!("Router {} sending {:?} on port {}", self.get_name().await, lsp, port)).await;
+            }
             sender.send(Message::OSPF(lsp.clone())).await.unwrap();
         }
     }
@@ -171,7 +196,9 @@ impl OSPFState{
     pub async fn send_hello(&self){
         for (port, (sender, _)) in self.get_igp_neighbors().await.iter() {
             let msg = Message::OSPF(Hello);
-            self.logger.log(Source::OSPF, format!("Router {} sending Hello on port {}", self.get_name().await, port)).await;
+            if self.logger.enabled(&Source::OSPF){
+                self.logger.log(Source::OSPF, format!("Router {} sending Hello on port {}", self.get_name().await, port)).await;
+            }
             sender.send(msg).await.unwrap();
         }
     }
@@ -179,7 +206,9 @@ impl OSPFState{
     pub async fn send_hello_reply(&self, port: u32){
         let map = self.get_igp_neighbors().await;
         let (sender, _) = map.get(&port).unwrap();
-        self.logger.log(Source::OSPF, format!("Router {} sending hello reply on port {}", self.get_name().await, port)).await;
+        if self.logger.enabled(&Source::OSPF){
+            self.logger.log(Source::OSPF, format!("Router {} sending hello reply on port {}", self.get_name().await, port)).await;
+        }
         let prefix = IPPrefix{ip: self.get_ip().await, prefix_len: 32};
         sender.send(Message::OSPF(OSPFMessage::HelloReply(prefix))).await.expect("Failed to send Hello reply");
     }
@@ -1,7 +1,7 @@
-use std::{cell::RefCell, collections::HashMap, net::Ipv4Addr, rc::Rc, sync::Arc, time::SystemTime};
+use std::{cell::RefCell, collections::{BTreeMap, HashMap, HashSet, VecDeque}, net::Ipv4Addr, rc::Rc, sync::{atomic::{AtomicUsize, Ordering}, Arc}, time::SystemTime};
 use tokio::sync::{mpsc::{channel, Receiver, Sender}, Mutex};
 
-use super::{ip_prefix::IPPrefix, logger::{Logger, Source}, messages::{ip::{Content, IP}, Message}, protocols::{arp::ArpState, bgp::BGPState}, utils::{MacAddress, SharedState}};
+use super::{ip_prefix::IPPrefix, logger::{Logger, Source}, messages::{bgp::BGPMessage, ip::{Content, IP}, Message}, protocols::{arp::ArpState, bgp::{BGPRoute, BGPState, CUSTOMER_PREF, PEER_PREF, PROVIDER_PREF}}, utils::{MacAddress, SharedState}};
 use super::communicators::{RouterCommunicator, Command, Response};
 use super::protocols::ospf::OSPFState;
 
@@ -21,6 +21,7 @@ pub struct RouterInfo{
     pub neighbors_links: HashMap<u32, Neighbor>,
     pub igp_links: HashMap<u32, IGPNeighbor>,
     pub bgp_links: HashMap<u32, BGPNeighbor>,
+    pub customer_links: Vec<u32>,
     pub ibgp_peers: Vec<Ipv4Addr>
 }
 
@@ -32,17 +33,18 @@ pub struct Router{
     pub igp_state: SharedState<OSPFState>,
     pub arp_state: SharedState<ArpState>,
     pub bgp_state: SharedState<BGPState>,
+    pub pending_bgp: Arc<AtomicUsize>, // bgp messages and announces of the network not yet processed
     pub logger: Logger
 }
 
 impl Router{
 
-    pub fn start(name: String, id: u32, router_as: u32, logger: Logger) -> RouterCommunicator{
+    pub fn start(name: String, id: u32, router_as: u32, logger: Logger, pending_bgp: Arc<AtomicUsize>) -> RouterCommunicator{
         let (tx_command, rx_command) = channel(1024);
         let (tx_response, rx_response) = channel(1024);
         let ip = Ipv4Addr::new(10, 0, router_as as u8, id as u8);
         let router_info = Arc::new(Mutex::new(RouterInfo{
-            name, 
+            name: name.clone(), 
             ip,
             id, 
             mac_address: MacAddress{id},
@@ -50,6 +52,7 @@ impl Router{
             neighbors_links: HashMap::new(), 
             igp_links: HashMap::new(),
             bgp_links: HashMap::new(),
+            customer_links: vec![],
             ibgp_peers: vec![]
         }));
         let arp_state = Arc::new(Mutex::new(ArpState::new(Arc::clone(&router_info), logger.clone())));
@@ -60,7 +63,8 @@ impl Router{
             command_replier: tx_response,
             igp_state: Arc::clone(&igp_state) ,
             arp_state,
-            bgp_state: Arc::new(Mutex::new(BGPState::new(router_info, igp_state, logger.clone()))),
+            bgp_state: Arc::new(Mutex::new(BGPState::new(name, id, router_as, ip, router_info, igp_state, logger.clone(), Arc::clone(&pending_bgp)))),
+            pending_bgp,
             logger
         };
         tokio::spawn(async move {
@@ -72,10 +76,14 @@ impl Router{
     pub async fn run(&mut self){
         let mut time = SystemTime::now();
         loop{
-            if self.receive_command().await{
+            // messages are collected before reading the commands, so that a command sent
+            // before a message arrived is always applied before that message is processed
+            let received_messages = self.collect_messages().await;
+            if self.receive_commands().await{
                 return;
             }
-            self.receive_messages().await;
+            let idle = received_messages.is_empty();
+            self.process_messages(received_messages).await;
             if time.elapsed().unwrap().as_millis() > 200{
                 // every 200ms, send an hello message, and refresh arp state
                 time = SystemTime::now();
@@ -86,28 +94,51 @@ impl Router{
                     arp_state.resolve(ip.ip, *port).await;
                 }
             }
+            if idle{
+                // nothing to do, let the other devices run on this worker instead of spinning
+                tokio::task::yield_now().await;
+            }
         }
     }
 
-    pub async fn receive_messages(&mut self){
-        let mut received_messages = vec![];
+    pub async fn collect_messages(&self) -> VecDeque<(Message, u32)>{
+        let mut received_messages = VecDeque::new();
         let info = self.router_info.lock().await;
         for (port, (receiver, _)) in info.neighbors_links.iter(){
+            // drain everything that is waiting on the port, instead of a single message per loop
             let mut receiver = receiver.lock().await;
-            if let Ok(message) = receiver.try_recv(){
-                received_messages.push((message, *port));
+            while let Ok(message) = receiver.try_recv(){
+                received_messages.push_back((message, *port));
             }
         }
-        let name = info.name.clone();
-        drop(info);
-        for (message, port) in received_messages{
-            self.logger.log(Source::DEBUG, format!("Router {} received {:?}", name, message)).await;
+        let (received_messages, dropped) = coalesce_bgp_updates(received_messages);
+        if dropped > 0{
+            // the superseded messages won't be processed
+            self.pending_bgp.fetch_sub(dropped, Ordering::SeqCst);
+        }
+        received_messages
+    }
+
+    pub async fn process_messages(&mut self, mut received_messages: VecDeque<(Message, u32)>){
+        let name = self.router_info.lock().await.name.clone();
+        while let Some((message, port)) = received_messages.pop_front(){
+            if self.logger.enabled(&Source::DEBUG){
+                self.logger.log(Source::DEBUG, format!("Router {} received {:?}", name, message)).await;
+            }
             
             match message{
                 Message::BPDU(_) => (), // don't care about bdpus
-                Message::OSPF(ospf) => self.igp_state.lock().await.process_ospf(ospf, port).await,
+                Message::OSPF(ospf) => {
+                    let changed = self.igp_state.lock().await.process_ospf(ospf, port).await;
+                    if changed{
+                        self.bgp_state.lock().await.igp_changed().await;
+                    }
+                },
                 Message::EthernetFrame(mac, ip) => self.process_frame(port, mac, ip).await,
-                Message::BGP(bgp_message) => self.bgp_state.lock().await.process_bgp_message(port, bgp_message).await,
+                Message::BGP(bgp_message) => {
+                    self.bgp_state.lock().await.process_bgp_message(port, bgp_message).await;
+                    self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
+                },
                 Message::ARP(arp_message) => self.arp_state.lock().await.process_arp_message(arp_message, port).await,
             }
         }
@@ -117,18 +148,27 @@ impl Router{
         let self_mac = self.router_info.lock().await.mac_address.clone();
         if self_mac == mac{
             self.process_ip(port, content).await;
+        }else if let Content::IBGP(_) = content.content{
+            // copy flooded by a switch for another router, dropped here
+            self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
         }
     }
 
     pub async fn process_ip(&self, port: u32, ip_packet: IP){
         let info = self.router_info.lock().await;
         let ip = info.ip.clone();
-        self.logger.log(Source::IP, format!("Router {} received ip packet {:?}", info.name, ip_packet)).await;
+        if self.logger.enabled(&Source::IP){
+            self.logger.log(Source::IP, format!("Router {} received ip packet {:?}", info.name, ip_packet)).await;
+        }
         drop(info);
         if ip_packet.dest == ip{
             self.process_ip_content(port, ip_packet).await;
         }else{
-            self.send_message(ip_packet.dest, ip_packet).await;
+            let ibgp = matches!(ip_packet.content, Content::IBGP(_));
+            if !self.send_message(ip_packet.dest, ip_packet).await && ibgp{
+                // no route to the peer, the message is lost
+                self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
+            }
         }
     }
 
@@ -149,17 +189,19 @@ impl Router{
                 self.logger.log(Source::IP, format!("Router {} received data {} from {}", name, data, ip_packet.src)).await;
             },
             Content::IBGP(ibgp_message) => {
-                self.bgp_state.lock().await.process_ibgp_message(port, ibgp_message).await
+                self.bgp_state.lock().await.process_ibgp_message(port, ibgp_message).await;
+                self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
             },
         }
     }
 
-    pub async fn send_message(&self, dest: Ipv4Addr, message: IP){
+    // returns whether the message could be sent
+    pub async fn send_message(&self, dest: Ipv4Addr, message: IP) -> bool{
         let bgp_state = self.bgp_state.lock().await;
         if let Some(nexthop) = bgp_state.get_nexthop(dest).await{
-            self.igp_state.lock().await.send_message(nexthop, message).await;
+            self.igp_state.lock().await.send_message(nexthop, message).await
         }else{
-            self.igp_state.lock().await.send_message(message.dest, message).await;
+            self.igp_state.lock().await.send_message(message.dest, message).await
         }
     }
 
@@ -172,91 +214,216 @@ impl Router{
         self.send_message(dest, IP{src, dest, content: Content::Ping}).await;
     }
 
-    pub async fn receive_command(&mut self) -> bool{
-        match self.command_receiver.try_recv(){
-            Ok(command) => {
-                match command{
-                    Command::AddLink(receiver, sender, port, cost) => {
-                        let mut info = self.router_info.lock().await;
-                        self.logger.log(Source::DEBUG, format!("Router {} received adding link", info.name)).await;
-                        let receiver = Arc::new(Mutex::new(receiver));
-                        info.neighbors_links.insert(port, (receiver, sender));
-                        info.igp_links.insert(port, cost);
-                        false
-                    },
-                    Command::Quit => true,
-                    Command::StatePorts => panic!("Unsupported command"),
-                    Command::Ping(dest) => {
-                        self.send_ping(dest).await;
-                        false
-                    },
-                    Command::RoutingTable => {
-                        self.command_replier.send(Response::RoutingTable(self.igp_state.lock().await.routing_table.clone())).await.expect("Failed to send the routing table");
-                        false
-                    },
-                    Command::AddPeerLink(receiver, sender, port, med, other_ip) => {
-                        let mut info = self.router_info.lock().await;
-                        self.logger.log(Source::DEBUG, format!("Router {} received adding peer link", info.name)).await;
-                        let receiver = Arc::new(Mutex::new(receiver));
-                        info.neighbors_links.insert(port, (receiver, sender));
-                        info.bgp_links.insert(port, (100, med));
-                        let prefix = IPPrefix{ip: other_ip, prefix_len: 32};
-                        let mut igp_state = self.igp_state.lock().await;
-                        igp_state.routing_table.insert(prefix, (port, 1));
-                        igp_state.prefixes.insert(prefix, prefix);
-                        igp_state.direct_neighbors.insert((1, port, prefix));
-                        false
-                    },
-                    Command::AddProvider(receiver, sender, port, med, other_ip) => {
-                        let mut info = self.router_info.lock().await;
-                        self.logger.log(Source::DEBUG, format!("Router {} received adding provider link", info.name)).await;
-                        let receiver = Arc::new(Mutex::new(receiver));
-                        info.neighbors_links.insert(port, (receiver, sender));
-                        info.bgp_links.insert(port, (50, med));
-                        let prefix = IPPrefix{ip: other_ip, prefix_len: 32};
-                        let mut igp_state = self.igp_state.lock().await;
-                        igp_state.routing_table.insert(prefix, (port, 1));
-                        igp_state.prefixes.insert(prefix, prefix);
-                        igp_state.direct_neighbors.insert((1, port, prefix));
-                        false
-                    },
-                    Command::AddCustomer(receiver, sender, port, med, other_ip) => {
-                        let mut info = self.router_info.lock().await;
-                        self.logger.log(Source::DEBUG, format!("Router {} received adding customer link", info.name)).await;
-                        let receiver = Arc::new(Mutex::new(receiver));
-                        info.neighbors_links.insert(port, (receiver, sender));
-                        info.bgp_links.insert(port, (150, med));
-                        let prefix = IPPrefix{ip: other_ip, prefix_len: 32};
-                        let mut igp_state = self.igp_state.lock().await;
-                        igp_state.routing_table.insert(prefix, (port, 1));
-                        igp_state.prefixes.insert(prefix, prefix);
-                        igp_state.direct_neighbors.insert((1, port, prefix));
-                        false
-                    },
-                    Command::AnnouncePrefix => {
-                        self.bgp_state.lock().await.announce_prefix().await;
-                        false
-                    },
-                    Command::BGPRoutes => {
-                        let bgp_state = self.bgp_state.lock().await;
-                        let mut routes = HashMap::new();
-                        
-                        for (prefix, r) in bgp_state.routes.iter(){
-                            let best_route = bgp_state.decision_process(*prefix).await;
-                            routes.insert(*prefix, (best_route, r.clone()));
-                        }
-                        self.command_replier.send(Response::BGPRoutes(routes)).await.expect("Failed to send the routing table");
-                        false
-                    },
-                    Command::AddIBGP(peer_addr) => {
-                        let mut info = self.router_info.lock().await;
-                        self.logger.log(Source::DEBUG, format!("Router {} received adding ibp connection to {}", info.name, peer_addr)).await;
-                        info.ibgp_peers.push(peer_addr);
-                        false
-                    },
+    pub async fn receive_commands(&mut self) -> bool{
+        // apply every pending command, returns whether the router must stop
+        while let Ok(command) = self.command_receiver.try_recv(){
+            if self.process_command(command).await{
+                return true;
+            }
+        }
+        false
+    }
+
+    pub async fn process_command(&mut self, command: Command) -> bool{
+        match command{
+            Command::AddLink(receiver, sender, port, cost) => {
+                let mut info = self.router_info.lock().await;
+                self.logger.log(Source::DEBUG, format!("Router {} received adding link", info.name)).await;
+                let receiver = Arc::new(Mutex::new(receiver));
+                info.neighbors_links.insert(port, (receiver, sender));
+                info.igp_links.insert(port, cost);
+                false
+            },
+            Command::Quit => true,
+            Command::StatePorts => panic!("Unsupported command"),
+            Command::Ping(dest) => {
+                self.send_ping(dest).await;
+                false
+            },
+            Command::RoutingTable => {
+                self.command_replier.send(Response::RoutingTable(self.igp_state.lock().await.routing_table.clone())).await.expect("Failed to send the routing table");
+                false
+            },
+            Command::AddPeerLink(receiver, sender, port, med, other_ip) => {
+                let mut info = self.router_info.lock().await;
+                self.logger.log(Source::DEBUG, format!("Router {} received adding peer link", info.name)).await;
+                let receiver = Arc::new(Mutex::new(receiver));
+                info.neighbors_links.insert(port, (receiver, sender));
+                info.bgp_links.insert(port, (PEER_PREF, med));
+                let prefix = IPPrefix{ip: other_ip, prefix_len: 32};
+                let mut igp_state = self.igp_state.lock().await;
+                igp_state.routing_table.insert(prefix, (port, 1));
+                igp_state.prefixes.insert(prefix, prefix);
+                igp_state.direct_neighbors.insert((1, port, prefix));
+                false
+            },
+            Command::AddProvider(receiver, sender, port, med, other_ip) => {
+                let mut info = self.router_info.lock().await;
+                self.logger.log(Source::DEBUG, format!("Router {} received adding provider link", info.name)).await;
+                let receiver = Arc::new(Mutex::new(receiver));
+                info.neighbors_links.insert(port, (receiver, sender));
+                info.bgp_links.insert(port, (PROVIDER_PREF, med));
+                let prefix = IPPrefix{ip: other_ip, prefix_len: 32};
+                let mut igp_state = self.igp_state.lock().await;
+                igp_state.routing_table.insert(prefix, (port, 1));
+                igp_state.prefixes.insert(prefix, prefix);
+                igp_state.direct_neighbors.insert((1, port, prefix));
+                false
+            },
+            Command::AddCustomer(receiver, sender, port, med, other_ip) => {
+                let mut info = self.router_info.lock().await;
+                self.logger.log(Source::DEBUG, format!("Router {} received adding customer link", info.name)).await;
+                let receiver = Arc::new(Mutex::new(receiver));
+                info.neighbors_links.insert(port, (receiver, sender));
+                info.bgp_links.insert(port, (CUSTOMER_PREF, med));
+                info.customer_links.push(port);
+                let prefix = IPPrefix{ip: other_ip, prefix_len: 32};
+                let mut igp_state = self.igp_state.lock().await;
+                igp_state.routing_table.insert(prefix, (port, 1));
+                igp_state.prefixes.insert(prefix, prefix);
+                igp_state.direct_neighbors.insert((1, port, prefix));
+                false
+            },
+            Command::AnnouncePrefix => {
+                self.bgp_state.lock().await.announce_prefix().await;
+                self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
+                false
+            },
+            Command::WithdrawPrefix => {
+                self.bgp_state.lock().await.withdraw_prefix().await;
+                self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
+                false
+            },
+            Command::BGPRoutes => {
+                let bgp_state = self.bgp_state.lock().await;
+                // ordered by prefix, tables can be compared and printed without hashing or sorting them
+                let mut routes = BTreeMap::new();
+                
+                for (prefix, rib) in bgp_state.routes.iter(){
+                    let mut paths: Vec<BGPRoute> = rib.paths.values().cloned().collect();
+                    paths.sort_by_key(|route| route.rib_order());
+                    routes.insert(*prefix, (rib.best.clone(), paths));
                 }
+                self.command_replier.send(Response::BGPRoutes(routes)).await.expect("Failed to send the routing table");
+                false
+            },
+            Command::ResetBGP => {
+                self.bgp_state.lock().await.reset().await;
+                false
             },
-            Err(_) => false,
+            Command::AddIBGP(peer_addr) => {
+                let mut info = self.router_info.lock().await;
+                self.logger.log(Source::DEBUG, format!("Router {} received adding ibp connection to {}", info.name, peer_addr)).await;
+                info.ibgp_peers.push(peer_addr);
+                false
+            },
+        }
+    }
+}
+
+// a bgp update replaces whatever the same peer previously sent for the prefix,
+// so only the last update of a batch has to go through the decision process.
+// Returns the messages to process, in their order, and the number of messages dropped
+pub fn coalesce_bgp_updates(received_messages: VecDeque<(Message, u32)>) -> (VecDeque<(Message, u32)>, usize){
+    if received_messages.len() < 2{
+        return (received_messages, 0);
+    }
+    let mut updated = HashSet::new();
+    let mut kept = VecDeque::with_capacity(received_messages.len());
+    let mut dropped = 0;
+    for (message, port) in received_messages.into_iter().rev(){
+        if let Message::BGP(BGPMessage::Update(prefix, nexthop, _, _, router_id) | BGPMessage::Withdraw(prefix, nexthop, _, router_id)) = &message{
+            let key = (port, *prefix, *nexthop, *router_id);
+            if updated.contains(&key){
+                // superseded by a later update
+                dropped += 1;
+                continue;
+            }
+            if let Message::BGP(BGPMessage::Update(..)) = message{
+                updated.insert(key);
+            }
         }
+        kept.push_front((message, port));
+    }
+    (kept, dropped)
+}
+
+#[cfg(test)]
+mod tests {
+    use std::{collections::VecDeque, net::Ipv4Addr};
+
+    use crate::network::messages::{bgp::BGPMessage, Message};
+    use super::coalesce_bgp_updates;
+
+    fn update(prefix: &str, nexthop: [u8; 4], as_path: Vec<u32>) -> Message{
+        let router_id = nexthop[3] as u32;
+        Message::BGP(BGPMessage::Update(prefix.parse().unwrap(), Ipv4Addr::from(nexthop), as_path.into(), 0, router_id))
+    }
+
+    fn withdraw(prefix: &str, nexthop: [u8; 4], as_path: Vec<u32>) -> Message{
+        let router_id = nexthop[3] as u32;
+        Message::BGP(BGPMessage::Withdraw(prefix.parse().unwrap(), Ipv4Addr::from(nexthop), as_path.into(), router_id))
+    }
+
+    // messages kept, as displayed since messages can't be compared, with their port
+    fn coalesce(messages: Vec<(Message, u32)>) -> (Vec<(String, u32)>, usize){
+        let (kept, dropped) = coalesce_bgp_updates(VecDeque::from(messages));
+        let kept = kept.into_iter().map(|(message, port)| (display(message), port)).collect();
+        (kept, dropped)
+    }
+
+    fn display(message: Message) -> String{
+        match message{
+            Message::BGP(bgp) => bgp.to_string(),
+            message => format!("{:?}", message)
+        }
+    }
+
+    #[test]
+    fn test_coalesce_updates() {
+        let (kept, dropped) = coalesce(vec![
+            (update("10.0.2.0/24", [10, 0, 2, 2], vec![2]), 1),
+            (update("10.0.2.0/24", [10, 0, 2, 2], vec![2, 3, 4]), 1),
+        ]);
+        assert_eq!(kept, vec![(display(update("10.0.2.0/24", [10, 0, 2, 2], vec![2, 3, 4])), 1)]);
+        assert_eq!(dropped, 1);
+    }
+
+    #[test]
+    fn test_coalesce_withdraw_then_update() {
+        let (kept, dropped) = coalesce(vec![
+            (withdraw("10.0.2.0/24", [10, 0, 2, 2], vec![2]), 1),
+            (update("10.0.2.0/24", [10, 0, 2, 2], vec![2, 3]), 1),
+        ]);
+        assert_eq!(kept, vec![(display(update("10.0.2.0/24", [10, 0, 2, 2], vec![2, 3])), 1)]);
+        assert_eq!(dropped, 1);
+    }
+
+    #[test]
+    fn test_coalesce_update_then_withdraw() {
+        // the withdraw only removes a matching route, the update must be applied first
+        let (kept, dropped) = coalesce(vec![
+            (update("10.0.2.0/24", [10, 0, 2, 2], vec![2]), 1),
+            (withdraw("10.0.2.0/24", [10, 0, 2, 2], vec![2]), 1),
+        ]);
+        assert_eq!(kept, vec![
+            (display(update("10.0.2.0/24", [10, 0, 2, 2], vec![2])), 1),
+            (display(withdraw("10.0.2.0/24", [10, 0, 2, 2], vec![2])), 1),
+        ]);
+        assert_eq!(dropped, 0);
+    }
+
+    #[test]
+    fn test_coalesce_other_peers() {
+        let messages = vec![
+            (update("10.0.2.0/24", [10, 0, 2, 2], vec![2]), 1),
+            (update("10.0.2.0/24", [10, 0, 3, 3], vec![3, 2]), 2),
+            (update("10.0.2.0/24", [10, 0, 2, 2], vec![2]), 3),
+            (update("10.0.4.0/24", [10, 0, 2, 2], vec![2, 4]), 1),
+        ];
+        let expected: Vec<(String, u32)> = messages.iter().map(|(message, port)| (display(message.clone()), *port)).collect();
+        let (kept, dropped) = coalesce(messages);
+        assert_eq!(kept, expected);
+        assert_eq!(dropped, 0);
     }
 }
\ No newline at end of file
@@ -1,4 +1,4 @@
-use std::{cell::RefCell, collections::{BTreeMap, HashMap}, rc::Rc, sync::Arc, time::SystemTime};
+use std::{cell::RefCell, collections::{BTreeMap, HashMap}, rc::Rc, sync::{atomic::{AtomicUsize, Ordering}, Arc}, time::SystemTime};
 use tokio::sync::{mpsc::{channel, Receiver, Sender}, Mutex};
 
 use super::{logger::{Logger, Source}, messages::{bpdu::BPDU, Message}, utils::SharedState};
@@ -34,6 +34,7 @@ pub struct Switch{
     pub ports_states: HashMap<u32, PortState>,
     pub command_receiver: Receiver<Command>,
     pub command_replier: Sender<Response>,
+    pub pending_bgp: Arc<AtomicUsize>, // bgp messages of the network not yet processed, ibgp frames are flooded
     pub logger: Logger
 }
 
@@ -45,7 +46,7 @@ impl ToString for Switch{
 
 impl Switch{
 
-    pub fn start(name: String, id: u32, logger: Logger) -> SwitchCommunicator{
+    pub fn start(name: String, id: u32, logger: Logger, pending_bgp: Arc<AtomicUsize>) -> SwitchCommunicator{
         let (tx_command, rx_command) = channel(1024);
         let (tx_response, rx_response) = channel(1024);
         let mut switch = Switch{
@@ -58,6 +59,7 @@ impl Switch{
             bpdu: BPDU{root: id, distance: 0, switch: id, port: 0}, 
             command_receiver: rx_command,
             command_replier: tx_response,
+            pending_bgp,
             logger
         };
         tokio::spawn(async move {
@@ -73,12 +75,16 @@ impl Switch{
             if self.receive_command().await{
                 return;
             }
-            self.receive_ports().await;
+            let idle = !self.receive_ports().await;
             if time.elapsed().unwrap().as_millis() > 200{
                 // every 200ms, send my own bpdu
                 time = SystemTime::now();
                 self.send_bpdu().await;
             }
+            if idle{
+                // nothing to do, let the other devices run on this worker instead of spinning
+                tokio::task::yield_now().await;
+            }
             
         }
     }
@@ -108,7 +114,9 @@ impl Switch{
                     Command::AddProvider(_, _, _, _, _) => panic!("Adding provider link not supported on switch"),
                     Command::AddCustomer(_, _, _, _, _) => panic!("Adding customer link not supported on switch"),
                     Command::AnnouncePrefix => panic!("Announcing prefix not supported on switch"),
+                    Command::WithdrawPrefix => panic!("Withdrawing prefix not supported on switch"),
                     Command::BGPRoutes => panic!("BGPRoutes not supported on switch"),
+                    Command::ResetBGP => panic!("ResetBGP not supported on switch"),
                     Command::AddIBGP(_) => panic!("AddIBGP not supported on switch"),
                 }
             },
@@ -116,7 +124,8 @@ impl Switch{
         }
     }
 
-    pub async fn receive_ports(&mut self){
+    // returns whether a message was received
+    pub async fn receive_ports(&mut self) -> bool{
         let mut received_bpdus = vec![];
         let mut received_messages= vec![];
         for (port, receiver, _, cost) in self.neighbors.iter(){
@@ -126,25 +135,38 @@ impl Switch{
                 Ok(message) => {
                     if self.get_port_state(*port) != PortState::Blocked{
                         received_messages.push((*port, message))
+                    }else if message.is_ibgp(){
+                        self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
                     }
                 }
                 Err(_) => continue,
             }
         }
+        let received = !received_bpdus.is_empty() || !received_messages.is_empty();
         for (bpdu, port, cost) in received_bpdus{
             self.receive_bpdu(bpdu, port, cost).await;
         }
         for (port, message) in received_messages{
-            for (p, _, sender, _) in self.neighbors.iter(){
-                if port != *p && self.get_port_state(*p) != PortState::Blocked{
-                    sender.send(message.clone()).await.expect("Failed to broadcast message");
-                }
+            let ports: Vec<&Sender<Message>> = self.neighbors.iter()
+                .filter(|(p, _, _, _)| port != *p && self.get_port_state(*p) != PortState::Blocked)
+                .map(|(_, _, sender, _)| sender)
+                .collect();
+            if message.is_ibgp(){
+                // every copy is pending until a router processes or drops it, counted before sending
+                self.pending_bgp.fetch_add(ports.len(), Ordering::SeqCst);
+                self.pending_bgp.fetch_sub(1, Ordering::SeqCst);
+            }
+            for sender in ports{
+                sender.send(message.clone()).await.expect("Failed to broadcast message");
             }
         }
+        received
     }
 
     pub async fn receive_bpdu(&mut self, bpdu: BPDU, port: u32, distance: u32){
-        self.logger.log(Source::SPT, format!("Switch {} received BPDU {} on port {}", self.name, bpdu.to_string(), port)).await;
+        if self.logger.enabled(&Source::SPT){
+            self.logger.log(Source::SPT, format!("Switch {} received BPDU {} on port {}", self.name, bpdu.to_string(), port)).await;
+        }
         let prev = self.ports.get(&port);
         if let Some((prev_bpdu, _)) = prev{
             if prev_bpdu < &bpdu{
@@ -169,10 +191,14 @@ impl Switch{
         if port == self.root_port{
             self.ports_states.insert(port, PortState::Root);
         }else if bpdu < &self.bpdu{
-            self.logger.log(Source::SPT, format!("BPDU received ({}) by {} on port {} was better than self bpdu ({}), port {} becomes blocked", bpdu.to_string(), self.name, port, self.bpdu.to_string(), port)).await;
+            if self.logger.enabled(&Source::SPT){
+                self.logger.log(Source::SPT, format!("BPDU received ({}) by {} on port {} was better than self bpdu ({}), port {} becomes blocked", bpdu.to_string(), self.name, port, self.bpdu.to_string(), port)).await;
+            }
             self.ports_states.insert(port, PortState::Blocked);
         }else{
-            self.logger.log(Source::SPT, format!("BPDU received ({}) by {} on port {} was worse than self bpdu ({}), port {} becomes designated", bpdu.to_string(), self.name, port, self.bpdu.to_string(), port)).await;
+            if self.logger.enabled(&Source::SPT){
+                self.logger.log(Source::SPT, format!("BPDU received ({}) by {} on port {} was worse than self bpdu ({}), port {} becomes designated", bpdu.to_string(), self.name, port, self.bpdu.to_string(), port)).await;
+            }
             self.ports_states.insert(port, PortState::Designated);
         }
     }
@@ -184,7 +210,9 @@ impl Switch{
                 continue;
             }
             let bpdu = BPDU{root: self.bpdu.root, distance: self.bpdu.distance, switch: self.id, port: *port};
-            self.logger.log(Source::SPT, format!("Switch {} sending BPDU {} on port {}", self.name, bpdu.to_string(), port)).await;
+            if self.logger.enabled(&Source::SPT){
+                self.logger.log(Source::SPT, format!("Switch {} sending BPDU {} on port {}", self.name, bpdu.to_string(), port)).await;
+            }
             sender.send(Message::BPDU(bpdu)).await.unwrap();
         }
     }